@@ -0,0 +1,71 @@
+# Compares the ESU cluster enumeration with the old approach of growing frozensets and deduplicating them,
+# on synthetic graphs of increasing average degree.
+#
+#     $ python benchmarks/bench_clusters.py [--nodes 800] [--max-size 8] [--legacy-max-size 6]
+
+import argparse
+import os
+import random
+import sys
+import time
+from typing import List
+
+os.environ.setdefault("STS_INQUIRY_SETTINGS", os.path.join(os.path.dirname(os.path.abspath(__file__)), "settings.cfg"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sts_inquiry.pipeline.c_cluster import enumerate_clusters  # noqa: E402
+
+
+def synthetic_adjacency(n_nodes: int, avg_degree: float, seed: int = 0) -> List[List[int]]:
+    # Railway networks are roughly planar, so only connect nodes that are close to each other on a line.
+    rnd = random.Random(seed)
+    window = 8
+    p = avg_degree / (2 * window)
+    adj = [set() for _ in range(n_nodes)]
+    for node in range(n_nodes):
+        for other in range(node + 1, min(node + window + 1, n_nodes)):
+            if rnd.random() < p:
+                adj[node].add(other)
+                adj[other].add(node)
+    return [sorted(nghbrs) for nghbrs in adj]
+
+
+def legacy_enumerate(adj: List[List[int]], max_size: int):
+    all_clusters = [{frozenset({node}) for node in range(len(adj))}]
+    for _ in range(max_size - 1):
+        cur_clusters = set()
+        for cluster in all_clusters[-1]:
+            for nghbr in {nghbr for node in cluster for nghbr in adj[node] if nghbr not in cluster}:
+                cur_clusters.add(cluster.union({nghbr}))
+        all_clusters.append(cur_clusters)
+    return all_clusters
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nodes", type=int, default=800)
+    parser.add_argument("--max-size", type=int, default=8)
+    parser.add_argument("--legacy-max-size", type=int, default=6)
+    parser.add_argument("--degrees", type=float, nargs="+", default=[2.0, 2.5, 3.0, 3.5, 4.0])
+    args = parser.parse_args()
+
+    print(f"{'degree':>6} {'size':>4} {'clusters':>12} {'esu [s]':>9} {'legacy [s]':>10}")
+    for degree in args.degrees:
+        adj = synthetic_adjacency(args.nodes, degree)
+        for size in range(2, args.max_size + 1):
+            start = time.perf_counter()
+            clusters = enumerate_clusters(adj, size)
+            esu_time = time.perf_counter() - start
+
+            legacy_time = ""
+            if size <= args.legacy_max_size:
+                start = time.perf_counter()
+                legacy_clusters = legacy_enumerate(adj, size)
+                legacy_time = f"{time.perf_counter() - start:.3f}"
+                assert len(legacy_clusters[-1]) == len(clusters[-1])
+
+            print(f"{degree:>6} {size:>4} {sum(len(c) for c in clusters):>12} {esu_time:>9.3f} {legacy_time:>10}")
+
+
+if __name__ == "__main__":
+    main()
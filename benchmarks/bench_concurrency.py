@@ -0,0 +1,124 @@
+# Measures the search throughput and latency with an increasing number of threads that search the cache concurrently,
+# optionally while the players are being refreshed in the background. With --serialize, each search holds one global
+# lock, which is what searches used to do before the cache published immutable states.
+# Note that searches mostly hold the GIL, so threads cannot scale much; the point is that no search ever waits for
+# another search or for a refresh anymore.
+#
+#     $ python benchmarks/bench_concurrency.py [--scale 5] [--threads 1 2 4 8] [--seconds 5] [--player-updates 0.5]
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+from contextlib import nullcontext
+from datetime import datetime
+from threading import Thread, Lock, Event
+from typing import Tuple, List
+
+os.environ.setdefault("STS_INQUIRY_SETTINGS", os.path.join(os.path.dirname(os.path.abspath(__file__)), "settings.cfg"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import request  # noqa: E402
+
+from sts_inquiry import app, cache  # noqa: E402
+from sts_inquiry.consts import INSTANCES  # noqa: E402
+from sts_inquiry.forms import create_search_form  # noqa: E402
+from sts_inquiry.pipeline import apply_players  # noqa: E402
+from sts_inquiry.pipeline.a_fetch.player_fetcher import PlayerPrototype  # noqa: E402
+from sts_inquiry.pipeline.b_link import link_landscape  # noqa: E402
+from sts_inquiry.pipeline.c_cluster import cluster_landscape  # noqa: E402
+from sts_inquiry.pipeline.d_metrics import landscape_metrics, cluster_index  # noqa: E402
+from sts_inquiry.search import search  # noqa: E402
+from sts_inquiry.views import METRIC_COL_LABELS  # noqa: E402
+from synthetic import synthetic_landscape  # noqa: E402
+
+QUERIES = [
+    "", "clustersize=2", "clustersize=3&sortby1=mean_difficulty-desc",
+    "clustersize=4&sortby1=n_neighbors-asc&sortby2=mean_difent-desc",
+    "clustersize=2&regions=s1", "clustersize=3&regions=r2-r3&free=y",
+    "clustersize=2&nameincl=Hbf", "clustersize=3&nameexcl=Hbf&instance=2&sortby1=region_occupants-desc",
+    "clustersize=2&page=2&sortby1=nghbr_handovers-desc"
+]
+
+
+def random_players(world, rnd: random.Random):
+    return [PlayerPrototype(name=f"Player {idx}", stitz=False, start_time=datetime.now(), aid=stw.aid, instance=inst)
+            for idx, stw in enumerate(world.stws) for inst in INSTANCES if rnd.random() < 0.2]
+
+
+def run_search(query: str):
+    with app.test_request_context("/?" + query):
+        state = cache.get()
+        form = create_search_form(request.args, max_cluster_size=len(state.dfs),
+                                  superregions=state.world.superregions,
+                                  sortable_cols=list(METRIC_COL_LABELS.items()))
+        form.mark_used_fields()
+        search(state, form, int(request.args.get("page", 1)), None)
+
+
+def measure(n_threads: int, seconds: float, serialize: bool,
+            player_update_interval: float) -> Tuple[float, List[float]]:
+    lock = Lock()
+    stop = Event()
+    latencies = [[] for _ in range(n_threads)]
+
+    def searcher(thread_idx: int):
+        rnd = random.Random(thread_idx)
+        while not stop.is_set():
+            start = time.perf_counter()
+            with lock if serialize else nullcontext():
+                run_search(rnd.choice(QUERIES))
+            latencies[thread_idx].append(time.perf_counter() - start)
+
+    def player_updater():
+        rnd = random.Random()
+        while not stop.wait(player_update_interval):
+            state = cache.get()
+            players = random_players(state.world, rnd)
+            # The old searches held the lock for the whole player refresh.
+            with lock if serialize else nullcontext():
+                cache.update_players(state, *apply_players(state.world, state.dfs, players))
+
+    threads = [Thread(target=searcher, args=(thread_idx,)) for thread_idx in range(n_threads)]
+    if player_update_interval:
+        threads.append(Thread(target=player_updater))
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    all_latencies = [latency for thread_latencies in latencies for latency in thread_latencies]
+    return len(all_latencies) / seconds, all_latencies
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scale", type=float, default=5)
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--player-updates", type=float, default=0.5,
+                        help="seconds between background player refreshes; 0 disables them")
+    parser.add_argument("--serialize", action="store_true")
+    args = parser.parse_args()
+
+    world = link_landscape(*synthetic_landscape(args.scale))
+    dfs = list(landscape_metrics(world, cluster_landscape(world)))
+    indexes = [cluster_index(world, df, cluster_size) for cluster_size, df in enumerate(dfs, start=1)]
+    cache.update(world, dfs, indexes, *apply_players(world, dfs, random_players(world, random.Random(0))))
+
+    print(f"{'threads':>7} {'searches/s':>10} {'speedup':>7} {'p50 [ms]':>8} {'p99 [ms]':>8}")
+    base_throughput = None
+    for n_threads in args.threads:
+        throughput, latencies = measure(n_threads, args.seconds, args.serialize, args.player_updates)
+        base_throughput = base_throughput or throughput
+        percentiles = statistics.quantiles(latencies, n=100)
+        print(f"{n_threads:>7} {throughput:>10.1f} {throughput / base_throughput:>7.2f} "
+              f"{percentiles[49] * 1000:>8.1f} {percentiles[98] * 1000:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
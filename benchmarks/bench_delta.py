@@ -0,0 +1,73 @@
+# Verifies that patching the cluster dfs after small landscape changes yields exactly the same dfs as a full rebuild,
+# and compares the time both take.
+#
+#     $ python benchmarks/bench_delta.py [--scale 5]
+
+import argparse
+import os
+import sys
+import time
+from dataclasses import replace
+
+os.environ.setdefault("STS_INQUIRY_SETTINGS", os.path.join(os.path.dirname(os.path.abspath(__file__)), "settings.cfg"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pandas as pd  # noqa: E402
+
+from sts_inquiry.pipeline.a_fetch.landscape_fetcher import EdgePrototype  # noqa: E402
+from sts_inquiry.pipeline.b_link import link_landscape, diff_landscape  # noqa: E402
+from sts_inquiry.pipeline.c_cluster import cluster_landscape, cluster_around  # noqa: E402
+from sts_inquiry.pipeline.d_metrics import landscape_metrics, patch_landscape_metrics  # noqa: E402
+from synthetic import synthetic_landscape  # noqa: E402
+
+
+def mutate(protos):
+    superregion_protos, region_protos, edge_protos, stw_protos = protos
+    stw_protos = list(stw_protos)
+    edge_protos = list(edge_protos)
+
+    # Change a rating, add an edge, flip a handover, and remove one edge.
+    stw_protos[3] = replace(stw_protos[3], difficulty=1.0)
+    edge_protos.append(EdgePrototype(aid_1=stw_protos[10].aid, aid_2=stw_protos[25].aid, handover=False))
+    edge_protos[0] = replace(edge_protos[0], handover=not edge_protos[0].handover)
+    del edge_protos[5]
+
+    # Remove one stw and add a new one.
+    removed_aid = stw_protos.pop(40).aid
+    edge_protos = [edge for edge in edge_protos if removed_aid not in (edge.aid_1, edge.aid_2)]
+    stw_protos.append(replace(stw_protos[-1], aid=99999, name="New Stw"))
+    edge_protos.append(EdgePrototype(aid_1=stw_protos[-2].aid, aid_2=99999, handover=True))
+
+    return superregion_protos, region_protos, edge_protos, stw_protos
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scale", type=float, default=5)
+    args = parser.parse_args()
+
+    old_protos = synthetic_landscape(args.scale)
+    old_world = link_landscape(*old_protos)
+    old_dfs = list(landscape_metrics(old_world, cluster_landscape(old_world)))
+
+    new_world = link_landscape(*mutate(old_protos))
+
+    start = time.perf_counter()
+    full_dfs = list(landscape_metrics(new_world, cluster_landscape(new_world)))
+    full_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    changed_aids = diff_landscape(old_world, new_world)
+    delta_dfs = list(patch_landscape_metrics(new_world, old_world, old_dfs, changed_aids,
+                                             cluster_around(new_world, changed_aids)))
+    delta_time = time.perf_counter() - start
+
+    for cluster_size, (full_df, delta_df) in enumerate(zip(full_dfs, delta_dfs), start=1):
+        pd.testing.assert_frame_equal(full_df, delta_df)
+        print(f"Cluster size {cluster_size}: {len(full_df)} rows are identical.")
+
+    print(f"{len(changed_aids)} changed stws; full rebuild took {full_time:.3f}s, patching took {delta_time:.3f}s.")
+
+
+if __name__ == "__main__":
+    main()
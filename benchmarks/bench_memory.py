@@ -0,0 +1,69 @@
+# Compares the memory that the cluster dfs take up when every cluster row is duplicated per instance, as they used to
+# be, with the layout of one df row per cluster plus a narrow occupancy table with one row per cluster and instance.
+# The memory retained by each layout is traced while building it, so objects shared by several rows count only once.
+#
+#     $ python benchmarks/bench_memory.py [--scale 5]
+
+import argparse
+import gc
+import os
+import random
+import sys
+import tracemalloc
+from datetime import datetime
+
+os.environ.setdefault("STS_INQUIRY_SETTINGS", os.path.join(os.path.dirname(os.path.abspath(__file__)), "settings.cfg"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pandas as pd  # noqa: E402
+
+from sts_inquiry import app  # noqa: E402
+from sts_inquiry.consts import INSTANCES  # noqa: E402
+from sts_inquiry.pipeline import apply_players  # noqa: E402
+from sts_inquiry.pipeline.a_fetch.player_fetcher import PlayerPrototype  # noqa: E402
+from sts_inquiry.pipeline.b_link import link_landscape  # noqa: E402
+from sts_inquiry.pipeline.c_cluster import cluster_landscape  # noqa: E402
+from sts_inquiry.pipeline.d_metrics import landscape_metrics, PLAYER_COL_NAMES  # noqa: E402
+from synthetic import synthetic_landscape  # noqa: E402
+
+
+def build(world, players, duplicated: bool):
+    dfs = list(landscape_metrics(world, cluster_landscape(world)))
+    occupancy_tables, _ = apply_players(world, dfs, players)
+    if not duplicated:
+        return dfs, occupancy_tables
+    return [pd.concat((df.assign(instance=inst) for inst in INSTANCES), ignore_index=True)
+            .assign(**{col_name: occ[col_name].to_numpy() for col_name in PLAYER_COL_NAMES})
+            for df, occ in zip(dfs, occupancy_tables)]
+
+
+def retained_mib(fn) -> float:
+    gc.collect()
+    tracemalloc.start()
+    result = fn()
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return size / 2 ** 20
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scale", type=float, default=5)
+    args = parser.parse_args()
+
+    world = link_landscape(*synthetic_landscape(args.scale))
+    rnd = random.Random(0)
+    players = [PlayerPrototype(name="Player", stitz=False, start_time=datetime.now(), aid=stw.aid, instance=inst)
+               for stw in world.stws for inst in INSTANCES if rnd.random() < 0.2]
+
+    before = retained_mib(lambda: build(world, players, duplicated=True))
+    after = retained_mib(lambda: build(world, players, duplicated=False))
+    print(f"MAX_CLUSTER_SIZE = {app.config['MAX_CLUSTER_SIZE']}, {len(world.stws)} stws")
+    print(f"Duplicated per instance: {before:.1f} MiB")
+    print(f"Clusters + occupancy:    {after:.1f} MiB ({after / before:.0%})")
+
+
+if __name__ == "__main__":
+    main()
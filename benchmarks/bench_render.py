@@ -0,0 +1,73 @@
+# Measures how long it takes to serve complete result pages, including the rendering of the template, for a few
+# typical searches. Each page is served both buffered and streamed (see STREAM_PAGES), and for each, the time to the
+# first byte of the body and the peak memory that is allocated while serving it are measured too.
+#
+#     $ python benchmarks/bench_render.py [--scale 5] [--repeat 20]
+
+import argparse
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+os.environ.setdefault("STS_INQUIRY_SETTINGS", os.path.join(os.path.dirname(os.path.abspath(__file__)), "settings.cfg"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sts_inquiry import app, cache  # noqa: E402
+from sts_inquiry.pipeline import apply_players  # noqa: E402
+from sts_inquiry.pipeline.b_link import link_landscape  # noqa: E402
+from sts_inquiry.pipeline.c_cluster import cluster_landscape  # noqa: E402
+from sts_inquiry.pipeline.d_metrics import landscape_metrics, cluster_index  # noqa: E402
+from bench_concurrency import random_players  # noqa: E402
+from synthetic import synthetic_landscape  # noqa: E402
+
+QUERIES = [
+    "", "clustersize=2", "clustersize=4&sortby1=mean_difficulty-desc", "clustersize=6&sortby1=n_neighbors-asc",
+    "clustersize=3&regions=s1&instance=1"
+]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scale", type=float, default=5)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    world = link_landscape(*synthetic_landscape(args.scale))
+    dfs = list(landscape_metrics(world, cluster_landscape(world)))
+    indexes = [cluster_index(world, df, cluster_size) for cluster_size, df in enumerate(dfs, start=1)]
+    cache.update(world, dfs, indexes, *apply_players(world, dfs, random_players(world, random.Random(0))))
+
+    client = app.test_client()
+    print(f"{'query':<45} {'mode':<8} {'ms/page':>8} {'TTFB ms':>8} {'peak MiB':>8} {'KiB':>6}")
+    for query in QUERIES:
+        for stream in (False, True):
+            app.config["STREAM_PAGES"] = stream
+            # The first request warms up the template and the caches.
+            size = len(client.get("/?" + query).data)
+
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                client.get("/?" + query).get_data()
+            elapsed = (time.perf_counter() - start) / args.repeat
+
+            ttfb = 0
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                response = client.get("/?" + query, buffered=False)
+                next(iter(response.response))
+                ttfb += (time.perf_counter() - start) / args.repeat
+                response.close()
+
+            tracemalloc.start()
+            client.get("/?" + query).get_data()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            print(f"{query or '(default)':<45} {'streamed' if stream else 'buffered':<8} {elapsed * 1000:>8.1f} "
+                  f"{ttfb * 1000:>8.1f} {peak / 2 ** 20:>8.1f} {size / 1024:>6.0f}")
+
+
+if __name__ == "__main__":
+    main()
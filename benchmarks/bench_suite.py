@@ -0,0 +1,187 @@
+# Runs the landscape pipeline, the player pipeline and a mix of searches against a local copy of the StellwerkSim
+# website at several scales, and reports the time and memory of each stage. Each scale runs several times, each time in
+# a fresh process, so their peak memory does not add up; the fastest run of each stage and the median of its memory are
+# reported, and each search is timed by the median of its repeats. Save the results of a run to compare later runs
+# against them; stages that got slower or bigger than allowed by the tolerance are listed as regressions, and the exit
+# code is 1.
+#
+#     $ python benchmarks/bench_suite.py [--scales 1 5 20] [--runs 3] [--recorded STORE_DIR] [--save base.json]
+#     $ python benchmarks/bench_suite.py --baseline base.json [--tolerance 0.25]
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from typing import Dict, List
+
+from fixture_server import FixtureServer
+
+# Searches that are typical for the users of the site.
+QUERIES = [
+    "", "clustersize=2", "clustersize=3&sortby1=mean_difficulty-desc", "clustersize=4&sortby1=n_neighbors-asc",
+    "clustersize=3&regions=s1", "clustersize=2&regions=r2-r3&free=y", "clustersize=2&nameincl=Hbf",
+    "clustersize=3&instance=2&sortby1=region_occupants-desc", "clustersize=5&sortby1=nghbr_occupants-desc",
+    "clustersize=6&sortby1=min_entertainment-asc&sortby2=intra_handovers-desc", "clustersize=2&page=3"
+]
+# Timings below this many seconds are too noisy to be compared to the baseline, even as the best of several runs.
+_MIN_COMPARED_STAGE_SECS = 0.1
+_MIN_COMPARED_SEARCH_SECS = 0.02
+_MIN_COMPARED_BYTES = 8 << 20
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scales", type=float, nargs="+", default=[1, 5, 20])
+    parser.add_argument("--recorded", help="A copy of a FETCH_RESPONSE_STORE_DIR to use instead of the synthetic site.")
+    parser.add_argument("--runs", type=int, default=3, help="How often each scale is run.")
+    parser.add_argument("--repeat", type=int, default=5, help="How often each search is run per run.")
+    parser.add_argument("--save", help="Write the results to this JSON file.")
+    parser.add_argument("--baseline", help="Compare the results to those in this JSON file.")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--run-scale", type=float, help=argparse.SUPPRESS)
+    parser.add_argument("--out", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_scale is not None:
+        with open(args.out, "w") as f:
+            json.dump(run_scale(args.run_scale, args.recorded, args.repeat), f)
+        return
+
+    # Recorded responses only exist at a single scale.
+    scales = [1] if args.recorded else args.scales
+    results = {}
+    for scale in scales:
+        runs = []
+        for _ in range(args.runs):
+            with tempfile.NamedTemporaryFile(suffix=".json") as out:
+                subprocess.run([sys.executable, os.path.abspath(__file__), "--run-scale", str(scale),
+                                "--out", out.name, "--repeat", str(args.repeat)] +
+                               (["--recorded", args.recorded] if args.recorded else []), check=True)
+                runs.append(json.load(out))
+        results[_scale_label(scale, args.recorded)] = combine(runs)
+
+    width = max(len(name) for stages in results.values() for name in stages)
+    print(f"{'scale':<10} {'stage':<{width}} {'wall s':>8} {'CPU s':>8} {'+RSS MiB':>9}")
+    for label, stages in results.items():
+        for name, stage in stages.items():
+            print(f"{label:<10} {name:<{width}} {stage['wall']:>8.3f} {stage['cpu']:>8.3f} "
+                  f"{stage['peak_rss_increase'] / 2 ** 20:>9.1f}")
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=1)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(json.load(f), results, args.tolerance)
+        for regression in regressions:
+            print("REGRESSION:", regression)
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions beyond {args.tolerance:.0%} compared to {args.baseline}.")
+
+
+def run_scale(scale: float, recorded: str, repeat: int) -> Dict[str, Dict[str, float]]:
+    # The settings are read on import, so the server has to be up before sts_inquiry is imported.
+    tmp_dir = tempfile.mkdtemp(prefix="sts-bench-")
+    server = FixtureServer({})
+    settings_file = os.path.join(tmp_dir, "settings.cfg")
+    with open(settings_file, "w") as f:
+        f.write(f"CONFIGURE_LOGGING = False\nRUN_CACHE_UPDATER = False\nSNAPSHOT_DIR = \"\"\n"
+                f"STS_URL = \"{server.url}\"\nFETCH_USERNAME = \"benchmark\"\nFETCH_PASSWORD = \"benchmark\"\n"
+                f"FETCH_RATE_LIMIT = 0\nFETCH_RESPONSE_STORE_DIR = \"{os.path.join(tmp_dir, 'store')}\"\n")
+    os.environ["STS_INQUIRY_SETTINGS"] = settings_file
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    from flask import request
+    from sts_inquiry import app, cache
+    from sts_inquiry.forms import create_search_form
+    from sts_inquiry.instrumentation import stage, last_stage_runs
+    from sts_inquiry.pipeline import run_landscape_pipeline, apply_players
+    from sts_inquiry.pipeline.a_fetch import fetch_players
+    from sts_inquiry.search import search
+    from sts_inquiry.views import METRIC_COL_LABELS
+    from fixtures import synthetic_site, recorded_site
+
+    server.pages = recorded_site(recorded) if recorded else synthetic_site(scale)
+    results = {}
+    prev_runs = {}
+
+    def record(prefix: str):
+        # Only records the stages that have run since the last call.
+        nonlocal prev_runs
+        for name, run in last_stage_runs().items():
+            if run is not prev_runs.get(name):
+                results[f"{prefix}{name}"] = {"wall": run.wall, "cpu": run.cpu,
+                                              "peak_rss_increase": run.peak_rss_increase}
+        prev_runs = last_stage_runs()
+
+    # The second run only sends conditional requests and finds that nothing has changed.
+    with stage("landscape_pipeline"):
+        world, dfs, indexes = run_landscape_pipeline()
+    record("landscape/")
+    with stage("landscape_pipeline"):
+        world, dfs, indexes = run_landscape_pipeline(world, dfs)
+    record("refresh/")
+
+    with stage("fetch_players"):
+        players = fetch_players()
+    with stage("player_pipeline"):
+        occupancy, occupants = apply_players(world, dfs, players)
+    record("players/")
+
+    state = cache.update(world, dfs, indexes, occupancy, occupants)
+    for query in QUERIES:
+        with app.test_request_context("/?" + query):
+            form = create_search_form(request.args, max_cluster_size=len(state.dfs),
+                                      superregions=state.world.superregions,
+                                      sortable_cols=list(METRIC_COL_LABELS.items()))
+            form.mark_used_fields()
+            # Without a params key, every search ranks the clusters from scratch.
+            runs = []
+            for _ in range(repeat):
+                with stage("search"):
+                    search(state, form, int(request.args.get("page", 1)), None)
+                runs.append(last_stage_runs()["search"])
+        results[f"search/{query or '(default)'}"] = {
+            "wall": statistics.median(run.wall for run in runs), "cpu": statistics.median(run.cpu for run in runs),
+            "peak_rss_increase": max(run.peak_rss_increase for run in runs)
+        }
+
+    server.close()
+    return results
+
+
+def combine(runs: List[Dict[str, Dict[str, float]]]) -> Dict[str, Dict[str, float]]:
+    # The fastest run is the one that was disturbed the least by whatever else the machine was doing, while the memory
+    # hardly depends on that.
+    return {name: {"wall": min(run[name]["wall"] for run in runs),
+                   "cpu": min(run[name]["cpu"] for run in runs),
+                   "peak_rss_increase": statistics.median(run[name]["peak_rss_increase"] for run in runs)}
+            for name in runs[0]}
+
+
+def compare(baseline: Dict[str, Dict[str, Dict[str, float]]], results: Dict[str, Dict[str, Dict[str, float]]],
+            tolerance: float) -> List[str]:
+    regressions = []
+    for label, stages in results.items():
+        for name, stage in stages.items():
+            base = baseline.get(label, {}).get(name)
+            if base is None:
+                continue
+            min_compared_secs = _MIN_COMPARED_SEARCH_SECS if name.startswith("search/") else _MIN_COMPARED_STAGE_SECS
+            for key, min_compared in (("wall", min_compared_secs), ("peak_rss_increase", _MIN_COMPARED_BYTES)):
+                if stage[key] > max(base[key], min_compared) * (1 + tolerance):
+                    regressions.append(f"{label} {name} {key}: {base[key]:.3f} -> {stage[key]:.3f}")
+    return regressions
+
+
+def _scale_label(scale: float, recorded: str) -> str:
+    return "recorded" if recorded else f"{scale:g}x"
+
+
+if __name__ == "__main__":
+    main()
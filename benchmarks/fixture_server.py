@@ -0,0 +1,51 @@
+# A local stand-in for the StellwerkSim website. It only depends on the standard library, so it can be started before
+# sts_inquiry is imported, which reads STS_URL from the settings right away.
+
+import hashlib
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Dict
+
+
+class FixtureServer:
+    # Answers GET requests with the given pages and supports conditional requests via ETags, like the real site.
+    # The pages can be replaced while the server is running.
+
+    def __init__(self, pages: Dict[str, bytes]):
+        self.pages = pages
+        self.n_requests = 0
+        self.n_not_modified = 0
+
+        fixture_server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                fixture_server.n_requests += 1
+                content = fixture_server.pages.get(self.path.lstrip("/"))
+                if content is None:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                etag = f'"{hashlib.sha1(content).hexdigest()}"'
+                if self.headers.get("If-None-Match") == etag:
+                    fixture_server.n_not_modified += 1
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self._server.server_address[1]}/"
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,103 @@
+# Responses of the StellwerkSim website that the benchmarks serve from a FixtureServer, so that they can run the whole
+# pipeline, including the fetch stage, without ever touching the live site. The responses are either rendered from a
+# synthetic landscape or taken from recorded responses: run an instance with FETCH_RESPONSE_STORE_DIR set and pass a
+# copy of that directory to recorded_site(). The player list is not stored there, so it is always generated.
+
+import json
+import os
+import pickle
+import random
+import time
+from typing import Dict, Iterable
+from urllib.parse import urlsplit
+
+from sts_inquiry.consts import PLAYING_DURATION_CONVERSION, INSTANCES
+from sts_inquiry.pipeline.a_fetch.landscape_fetcher import StwPrototype
+from synthetic import synthetic_landscape
+
+_PLAYING_DURATION_TEXTS = {duration: text for text, duration in PLAYING_DURATION_CONVERSION.items()}
+
+
+def synthetic_site(scale: float = 1, seed: int = 0) -> Dict[str, bytes]:
+    # Returns the responses by the path and query relative to STS_URL.
+    superregion_protos, region_protos, edge_protos, stw_protos = synthetic_landscape(scale, seed)
+    pages = {}
+
+    superregion_cells = "".join(f"<td class='border1'><a href='javascript:show({proto.urid})'>{proto.name}</a></td>"
+                                for proto in superregion_protos)
+    region_rows = "".join(f"<tr class='regionname' rid='{proto.rid}' urid='{proto.urid}'>"
+                          f"<td class='regionname'>{proto.name}</td></tr>" for proto in region_protos)
+    pages["anlagen.php"] = \
+        f"<html><body><table><tr>{superregion_cells}</tr>{region_rows}</table></body></html>".encode()
+
+    # Like on the real site, the map of a region also shows the stws of other regions that its stws are connected to.
+    rids = {proto.aid: proto.rid for proto in stw_protos}
+    for region_proto in region_protos:
+        edges = [edge for edge in edge_protos if region_proto.rid in (rids[edge.aid_1], rids[edge.aid_2])]
+        aids = {proto.aid for proto in stw_protos if proto.rid == region_proto.rid}
+        aids.update(aid for edge in edges for aid in (edge.aid_1, edge.aid_2))
+        nodes = [{"kid": f"k{aid}", "aid": str(aid), "style": "1"} for aid in sorted(aids)]
+        nodes.append({"kid": "link", "style": "1"})
+        pages[f"landschaft-data.php?rid={region_proto.rid}"] = json.dumps({
+            "knoten": nodes,
+            "edges": [{"kid1": f"k{edge.aid_1}", "kid2": f"k{edge.aid_2}", "uep": edge.handover} for edge in edges]
+        }).encode()
+
+    for proto in stw_protos:
+        pages.update(_stw_pages(proto))
+
+    pages.update(players_site((proto.aid for proto in stw_protos), seed))
+    return pages
+
+
+def recorded_site(store_dir: str, seed: int = 0) -> Dict[str, bytes]:
+    pages = {}
+    for file_name in os.listdir(store_dir):
+        if file_name.endswith(".tmp"):
+            continue
+        with open(os.path.join(store_dir, file_name), "rb") as f:
+            stored = pickle.load(f)
+        url = urlsplit(stored.url)
+        pages[url.path.lstrip("/") + (f"?{url.query}" if url.query else "")] = stored.content
+
+    aids = [int(json.loads(content)["aid"]) for path, content in pages.items() if "m=anlage&" in path]
+    pages.update(players_site(aids, seed))
+    return pages
+
+
+def players_site(aids: Iterable[int], seed: int = 0) -> Dict[str, bytes]:
+    # The player list, plus the main page, which shows that the benchmark is logged in.
+    rnd = random.Random(seed)
+    now = int(time.time())
+    players = [{"userName": f"Player {aid}-{inst}", "aid": str(aid), "instanz": str(inst - 1),
+                "hasStiTz": rnd.random() < 0.5, "startTime": str(now - rnd.randint(0, 10000))}
+               for aid in aids for inst in INSTANCES if rnd.random() < 0.2]
+    return {"anlagen.php?subdata=ajax&m=players": json.dumps(players).encode(),
+            "": b"<html><body><a>Abmelden</a></body></html>"}
+
+
+def _stw_pages(proto: StwPrototype) -> Dict[str, bytes]:
+    # Stws with comments get a forum thread, whose first post is the shoutbox notice. The thread lists the comments
+    # from oldest to newest.
+    forum_id = proto.aid + 5000 if proto.comments else None
+    voting = "<div><b>Bewertung</b>"
+    if proto.difficulty is not None and proto.entertainment is not None:
+        voting += f"<b>{proto.difficulty:.2f}</b><b>{proto.entertainment:.2f}</b>"
+    if forum_id is not None:
+        voting += f"<a href='javascript:forum({forum_id})'>Forum</a>"
+    voting += "</div>"
+
+    pages = {f"anlagen.php?subdata=ajax&m=anlage&aid={proto.aid}": json.dumps({
+        "aid": str(proto.aid), "rid": str(proto.rid), "name": proto.name, "desc": str(proto.description),
+        "coords": [str(proto.latitude), str(proto.longitude)], "voting": voting
+    }).encode()}
+
+    if forum_id is not None:
+        posts = "".join(f"<div class='postbody'><div class='content'>{text}</div>"
+                        f"<p class='author'><time datetime='{year}-05-01T00:00:00'></time></p></div>"
+                        for text, year in [("Shoutbox", 2010)] + [
+                            (f"{comment.text}<br/>{_PLAYING_DURATION_TEXTS[comment.playing_duration]}", comment.year)
+                            for comment in reversed(proto.comments)])
+        pages[f"forum/viewtopic.php?t={forum_id}"] = f"<html><body>{posts}</body></html>".encode()
+
+    return pages
@@ -0,0 +1,51 @@
+# Generates synthetic landscapes that resemble the StellwerkSim network: regions of stws that are mostly connected
+# to stws close by, with a few connections to neighboring regions.
+
+import random
+from typing import List, Tuple
+
+from markupsafe import Markup
+
+from sts_inquiry.pipeline.a_fetch.landscape_fetcher import SuperRegionPrototype, RegionPrototype, EdgePrototype, \
+    StwPrototype
+from sts_inquiry.structs import Comment
+
+N_SUPERREGIONS = 4
+REGIONS_PER_SCALE = 12
+STWS_PER_REGION = 10
+
+
+def synthetic_landscape(scale: float = 1, seed: int = 0) -> Tuple[List[SuperRegionPrototype], List[RegionPrototype],
+                                                                  List[EdgePrototype], List[StwPrototype]]:
+    rnd = random.Random(seed)
+    n_regions = max(1, round(REGIONS_PER_SCALE * scale))
+
+    superregion_protos = [SuperRegionPrototype(urid=urid, name=f"Superregion {urid}")
+                          for urid in range(1, N_SUPERREGIONS + 1)]
+    region_protos = [RegionPrototype(rid=rid, urid=rid % N_SUPERREGIONS + 1, name=f"Region {rid}")
+                     for rid in range(1, n_regions + 1)]
+
+    stw_protos = []
+    edge_protos = []
+    for region_idx, region_proto in enumerate(region_protos):
+        aids = [1000 + region_idx * STWS_PER_REGION + offset for offset in range(STWS_PER_REGION)]
+        for aid in aids:
+            rated = rnd.random() < 0.8
+            stw_protos.append(StwPrototype(
+                aid=aid, rid=region_proto.rid,
+                name=f"Stw {aid}{' Hbf' if aid % 7 == 0 else ''}", description=Markup(f"<p>Stw {aid}</p>"),
+                latitude=50 + aid / 10000, longitude=8 + aid / 10000,
+                difficulty=round(rnd.uniform(1, 4), 2) if rated else None,
+                entertainment=round(rnd.uniform(1, 4), 2) if rated else None,
+                forum_id=None,
+                comments=[Comment(text=f"Comment {c} on stw {aid}", playing_duration="<30 min", year=2010 + c)
+                          for c in range(rnd.randint(0, 4))]))
+
+        for idx, aid in enumerate(aids):
+            for other_aid in aids[idx + 1:idx + 3]:
+                if rnd.random() < 0.7:
+                    edge_protos.append(EdgePrototype(aid_1=aid, aid_2=other_aid, handover=rnd.random() < 0.3))
+        if region_idx > 0:
+            edge_protos.append(EdgePrototype(aid_1=aids[0] - 1, aid_2=aids[0], handover=True))
+
+    return superregion_protos, region_protos, edge_protos, stw_protos
@@ -1,3 +1,4 @@
+import multiprocessing
 import os
 from urllib.parse import urljoin, urlencode
 
@@ -22,8 +23,11 @@ app.config.from_pyfile("settings.cfg")
 if "STS_INQUIRY_SETTINGS" in os.environ:
     app.config.from_envvar("STS_INQUIRY_SETTINGS")
 
+# Pipeline worker processes (see pipeline/parallel) import the app as well, but must not touch the logs or the cache.
+_is_pipeline_worker = multiprocessing.parent_process() is not None
+
 # Setup logging.
-if app.config["CONFIGURE_LOGGING"]:
+if app.config["CONFIGURE_LOGGING"] and not _is_pipeline_worker:
     app.logger.handlers.clear()
     setup_logging(app.config["LOG_DIR"])
 
@@ -43,4 +47,5 @@ app.jinja_env.globals.update(zip=zip, isnan=np.isnan,
 from . import views
 
 # Start the cache scheduler.
-from . import cache_updater
+if app.config["RUN_CACHE_UPDATER"] and not _is_pipeline_worker:
+    from . import cache_updater
@@ -1,31 +1,89 @@
+import dataclasses
+import secrets
+from dataclasses import dataclass
 from threading import Lock
-from typing import List
+from typing import Tuple, Dict, Optional, Sequence
 
 import pandas as pd
 
-from sts_inquiry.structs import World
+from sts_inquiry.fragments import StwFragments, render_stw_fragments
+from sts_inquiry.structs import World, Stw, Player, ClusterIndex
 
-# Because we cannot assume that operations on Pandas objects are thread-safe, we better make sure that
-# only one user request at the time can do stuff with the dfs.
-LOCK = Lock()
 
-ready: bool = False
-world: World
-dfs: List[pd.DataFrame]
+# Requests never lock the cache. Instead, each update builds a complete new State off to the side and then swaps the
+# reference to the current state, which is atomic. A request fetches the current state once and works on it from
+# start to end, so it always sees a consistent world and dfs, even if an update happens in the meantime.
+# Nothing that is reachable from a published state may ever be mutated.
+@dataclass(frozen=True)
+class State:
+    version: int
+    # Identify the landscape resp. the player list across all processes that serve the app, e.g., for HTTP caching.
+    landscape_version: str
+    players_version: str
+    world: World
+    # One row per cluster; these never change while the landscape stays the same.
+    # Cluster sizes that have not been materialized yet (see lazy_sizes) are None in all three tuples.
+    dfs: Tuple[Optional[pd.DataFrame], ...]
+    indexes: Tuple[Optional[ClusterIndex], ...]
+    # One row per cluster and instance, see player_metrics().
+    occupancy: Tuple[Optional[pd.DataFrame], ...]
+    # By (aid, instance)
+    occupants: Dict[Tuple[int, int], Player]
+    # Only changes together with the world.
+    stw_fragments: StwFragments
 
+    def occupant_at(self, stw: Stw, instance: int) -> Optional[Player]:
+        return self.occupants.get((stw.aid, instance))
 
-def update(new_world: World, new_dfs: List[pd.DataFrame]):
-    global ready, world, dfs
 
-    # Try to free memory.
-    try:
-        del world
-        for df in dfs[:]:
-            del df
-    except NameError:
-        # This happens on the first update when there's no old stuff to free.
-        pass
+# Only serializes the updaters among each other.
+_UPDATE_LOCK = Lock()
 
-    world = new_world
-    dfs = new_dfs
-    ready = True
+_state: Optional[State] = None
+
+
+def get() -> Optional[State]:
+    return _state
+
+
+def update(world: World, dfs: Sequence[Optional[pd.DataFrame]], indexes: Sequence[Optional[ClusterIndex]],
+           occupancy: Sequence[Optional[pd.DataFrame]], occupants: Dict[Tuple[int, int], Player],
+           landscape_version: Optional[str] = None, players_version: Optional[str] = None) -> State:
+    # Pass the snapshot versions if there are any. Otherwise, a new world resp. player list gets a random version.
+    global _state
+
+    with _UPDATE_LOCK:
+        same_world = _state is not None and _state.world is world
+        if landscape_version is None:
+            landscape_version = _state.landscape_version if same_world else secrets.token_hex(8)
+        if players_version is None:
+            players_version = secrets.token_hex(8)
+        stw_fragments = _state.stw_fragments if same_world else render_stw_fragments(world)
+        # The old state is freed as soon as the last request that uses it has finished.
+        _state = State(version=_state.version + 1 if _state is not None else 1,
+                       landscape_version=landscape_version, players_version=players_version,
+                       world=world, dfs=tuple(dfs), indexes=tuple(indexes), occupancy=tuple(occupancy),
+                       occupants=occupants, stw_fragments=stw_fragments)
+        return _state
+
+
+def update_players(expected: State, occupancy: Sequence[Optional[pd.DataFrame]],
+                   occupants: Dict[Tuple[int, int], Player], players_version: Optional[str] = None) -> Optional[State]:
+    # Replaces the players of the given state, keeping its landscape. The occupancy tables must match its dfs, so like
+    # replace(), nothing happens and None is returned if the cache has been updated in the meantime, e.g., because a
+    # cluster size has been materialized or evicted (see lazy_sizes). Then, compute the tables again for the new state.
+    if players_version is None:
+        players_version = secrets.token_hex(8)
+    return replace(expected, players_version=players_version, occupancy=tuple(occupancy), occupants=occupants)
+
+
+def replace(expected: State, **changes) -> Optional[State]:
+    # Publishes a copy of the given state with the given fields changed, unless the cache has been updated in the
+    # meantime, in which case None is returned and nothing happens.
+    global _state
+
+    with _UPDATE_LOCK:
+        if _state is not expected:
+            return None
+        _state = dataclasses.replace(expected, version=expected.version + 1, **changes)
+        return _state
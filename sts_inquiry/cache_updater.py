@@ -1,18 +1,83 @@
 import logging
+import math
+import time
+from datetime import datetime
 from threading import Thread, Timer
+from typing import Optional, Callable, List, Dict, Tuple, Sequence, Any
 
-from sts_inquiry import app, cache
-from sts_inquiry.pipeline import run_landscape_pipeline, run_player_pipeline
+import pandas as pd
+
+from sts_inquiry import app, cache, snapshot, instrumentation
+from sts_inquiry.instrumentation import stage, UPDATES
+from sts_inquiry.lazy_sizes import materialize_in_background, load_published
+from sts_inquiry.pipeline import run_landscape_pipeline, apply_players
+from sts_inquiry.pipeline.a_fetch import fetch_players
+from sts_inquiry.pipeline.a_fetch.player_fetcher import PlayerPrototype
+from sts_inquiry.structs import World, Player
 
 log = logging.getLogger("sts-inquiry")
 
 _fi_landscape = app.config["FETCH_INTERVAL_LANDSCAPE"]
 _fi_players = app.config["FETCH_INTERVAL_PLAYERS"]
 assert _fi_landscape % _fi_players == 0, "FETCH_INTERVAL_LANDSCAPE must be a multiple of FETCH_INTERVAL_PLAYERS"
+_poll_interval = app.config["SNAPSHOT_POLL_INTERVAL"]
+# Snapshot versions that fail to load are retried with exponential backoff up to this many seconds.
+_max_retry_delay = 3600
 
 _player_updates_per_landscape_update = _fi_landscape // _fi_players
 _remaining_player_updates_till_landscape_update = 0
 
+# Only the updater process fetches from the Sts website. All other processes follow the snapshots it publishes.
+_is_updater = False
+# The snapshot versions that are currently in the cache.
+_landscape_version: Optional[str] = None
+_landscape_created: Optional[datetime] = None
+_players_version: Optional[int] = None
+# By version, the number of failed attempts to load it and when to try again.
+_failed_versions: Dict[str, Tuple[int, float]] = {}
+
+
+def _boot():
+    # Serve the current snapshot right away so that a restart does not make the site unavailable
+    # until the next full landscape fetch has finished.
+    if snapshot.enabled():
+        version = snapshot.current_version()
+        if version is None or not _load_snapshot(version):
+            log.info("No usable landscape snapshot found.")
+
+    _tick()
+
+
+def _tick():
+    global _is_updater, _remaining_player_updates_till_landscape_update
+
+    if not _is_updater and snapshot.acquire_updater_lock():
+        _is_updater = True
+        # Only refresh the landscape we are already serving when it is due, but always fetch the players right away.
+        if _landscape_created is not None:
+            age = (datetime.now() - _landscape_created).total_seconds()
+            _remaining_player_updates_till_landscape_update = max(0, math.ceil((_fi_landscape - age) / _fi_players))
+        log.info("This process is now the updater. The next landscape update is due in %d player updates.",
+                 _remaining_player_updates_till_landscape_update)
+        # Take over materializing the large cluster sizes of the landscape we are already serving.
+        state = cache.get()
+        if state is not None and _remaining_player_updates_till_landscape_update > 0:
+            materialize_in_background(state.world, _landscape_version)
+
+    if _is_updater:
+        _periodic()
+        _publish_metrics()
+        interval = _fi_players
+    else:
+        _follow()
+        interval = _poll_interval
+
+    # Schedule the next iteration.
+    # We do this AFTER the update(s) so that they have enough time to complete before the next update starts.
+    t = Timer(interval, _tick)
+    t.daemon = True
+    t.start()
+
 
 def _periodic():
     global _remaining_player_updates_till_landscape_update
@@ -22,24 +87,123 @@ def _periodic():
         _fetch_and_handle_errors("world", _update_landscape_and_players)
     else:
         # Only try to fetch players if the landscape has successfully been fetched.
-        if hasattr(cache, "world"):
+        if cache.get() is not None:
             _fetch_and_handle_errors("player list", _update_players)
 
     _remaining_player_updates_till_landscape_update -= 1
 
-    # Schedule the next iteration.
-    # We do this AFTER the update(s) so that they have enough time to complete before the next update starts.
-    t = Timer(_fi_players, _periodic)
-    t.daemon = True
-    t.start()
+
+def _publish_metrics():
+    # The followers serve the updater metrics from the snapshot directory, since only this process runs the pipelines.
+    if not app.config["METRICS_ENABLED"] or not snapshot.enabled():
+        return
+    try:
+        snapshot.publish_metrics(instrumentation.render(updater=True))
+    except OSError as e:
+        log.warning("Failed to publish the metrics: %s: %s", e.__class__.__name__, e)
+
+
+def _follow():
+    global _players_version
+
+    try:
+        version = snapshot.current_version()
+        if version is not None and version != _landscape_version and \
+                time.monotonic() >= _failed_versions.get(version, (0, 0))[1]:
+            _load_snapshot(version)
+
+        published = snapshot.load_players()
+        if published is not None and published["landscape_version"] == _landscape_version and \
+                published["version"] != _players_version:
+            # Large cluster sizes might be added or evicted while we are computing, so retry until the players have
+            # been applied to the latest state.
+            while True:
+                state = cache.get()
+                if cache.update_players(state, *_shared_players(state.world, state.dfs, _landscape_version, published),
+                                        players_version=str(published["version"])) is not None:
+                    break
+            _players_version = published["version"]
+
+        load_published()
+    except Exception as e:
+        log.exception("Failed to follow the published snapshots: %s: %s", e.__class__.__name__, e)
+
+
+def _load_snapshot(version: str) -> bool:
+    global _landscape_version, _landscape_created, _players_version
+
+    log.info("Loading landscape snapshot version %s...", version)
+    try:
+        loaded = snapshot.load(version)
+    except Exception as e:
+        failures = _failed_versions.get(version, (0, 0))[0] + 1
+        delay = min(_poll_interval * 2 ** failures, _max_retry_delay)
+        _failed_versions[version] = failures, time.monotonic() + delay
+        log.exception("Failed to load the landscape snapshot: %s: %s", e.__class__.__name__, e)
+        log.error("Will retry to load landscape snapshot version %s in %d seconds.", version, delay)
+        return False
+    if loaded is None:
+        # The version has been replaced while we were loading it, so just load the current one on the next poll.
+        return False
+    _failed_versions.clear()
+
+    # Start out with the published players of this version, if there are any yet.
+    world, dfs, indexes, created = loaded
+    published = snapshot.load_players()
+    if published is None or published["landscape_version"] != version:
+        published = None
+    cache.update(world, dfs, indexes, *_shared_players(world, dfs, version, published), landscape_version=version,
+                 players_version=str(published["version"]) if published is not None else None)
+    _landscape_version, _landscape_created = version, created
+    _players_version = published["version"] if published is not None else None
+
+    log.info("Now serving landscape snapshot version %s, which is %s old.",
+             version, _format_age((datetime.now() - created).total_seconds()))
+    return True
+
+
+def _shared_players(world: World, dfs: Sequence[Optional[pd.DataFrame]], landscape_version: str,
+                    published: Optional[Dict[str, Any]]) \
+        -> Tuple[List[Optional[pd.DataFrame]], Dict[Tuple[int, int], Player]]:
+    # Maps the occupancy tables that the updater has published for the given player list into memory and only computes
+    # the missing ones, e.g., those of cluster sizes that the updater has not materialized.
+    if published is None:
+        return apply_players(world, dfs, [])
+    occupancy = snapshot.load_occupancy(landscape_version, published["version"], dfs)
+    missing_dfs = [df if occ is None else None for df, occ in zip(dfs, occupancy)]
+    computed, occupants = apply_players(world, missing_dfs, published["players"])
+    return [occ if occ is not None else comp for occ, comp in zip(occupancy, computed)], occupants
+
+
+def _share_occupancy(landscape_version: Optional[str], players_version: int, dfs: Sequence[Optional[pd.DataFrame]],
+                     occupancy: List[Optional[pd.DataFrame]]) -> List[Optional[pd.DataFrame]]:
+    # Publishes the given occupancy tables for the followers and returns them memory-mapped, so that this process
+    # shares them with all others, too.
+    if landscape_version is None:
+        return occupancy
+    try:
+        snapshot.publish_occupancy(landscape_version, players_version, occupancy)
+        shared = snapshot.load_occupancy(landscape_version, players_version, dfs)
+    except Exception as e:
+        # The followers then compute the tables themselves.
+        log.exception(" * Failed to publish the occupancy tables: %s: %s", e.__class__.__name__, e)
+        return occupancy
+    return [shared_occ if shared_occ is not None else occ for shared_occ, occ in zip(shared, occupancy)]
+
+
+def _format_age(secs: float) -> str:
+    mins = round(secs / 60)
+    return f"{mins // 60}h {mins % 60}m"
 
 
 def _fetch_and_handle_errors(label, update_fn):
     log.info("A %s cache update is due. Will now start fetching the current %s...", label, label)
     try:
         update_fn()
+        UPDATES.inc(kind=label, outcome="success")
         log.info("Successfully finished updating the %s cache.", label)
     except Exception as e:
+        UPDATES.inc(kind=label, outcome="failure")
         log.exception(" * %s: %s", e.__class__.__name__, e)
         if e.__cause__:
             log.exception(" * Caused by %s: %s", e.__cause__.__class__.__name__, e.__cause__)
@@ -48,22 +212,71 @@ def _fetch_and_handle_errors(label, update_fn):
 
 
 def _update_landscape_and_players():
-    world, dfs = run_landscape_pipeline()
+    # Only recompute what has changed compared to the landscape that is currently served (if any).
+    state = cache.get()
+    world, dfs, indexes = run_landscape_pipeline(*((state.world, state.dfs) if state is not None else ()))
+    version, created = None, datetime.now()
 
-    def update_cache():
-        with cache.LOCK:
-            cache.update(world, dfs)
+    if snapshot.enabled():
+        try:
+            with stage("publish_snapshot"):
+                published_version = snapshot.publish(world, dfs, indexes)
+            # Serve the published version so that this process shares the memory-mapped columns with all others.
+            world, dfs, indexes, created = snapshot.load(published_version)
+            version = published_version
+        except Exception as e:
+            # A failed snapshot only affects the other processes, so still serve the new landscape here.
+            log.exception(" * Failed to publish the landscape snapshot: %s: %s", e.__class__.__name__, e)
+
+    def update_cache(players, players_version):
+        global _landscape_version, _landscape_created, _players_version
+        occupancy, occupants = apply_players(world, dfs, players)
+        occupancy = _share_occupancy(version, players_version, dfs, occupancy)
+        cache.update(world, dfs, indexes, occupancy, occupants,
+                     landscape_version=version, players_version=str(players_version))
+        _landscape_version, _landscape_created, _players_version = version, created, None
 
     try:
-        run_player_pipeline(world, dfs, None)
-        update_cache()
+        _fetch_players(update_cache)
+    finally:
+        # The large cluster sizes of the previous landscape are patched where possible.
+        materialize_in_background(world, version, state)
+
+
+def _update_players():
+    def update_cache(players, players_version):
+        # Large cluster sizes might be added or evicted while we are computing, so retry until the players have been
+        # applied to the latest state.
+        while True:
+            state = cache.get()
+            occupancy, occupants = apply_players(state.world, state.dfs, players)
+            occupancy = _share_occupancy(_landscape_version, players_version, state.dfs, occupancy)
+            if cache.update_players(state, occupancy, occupants, players_version=str(players_version)) is not None:
+                return
+
+    _fetch_players(update_cache)
+
+
+def _fetch_players(update_cache: Callable[[List[PlayerPrototype], int], None]):
+    # The followers serve the published players under the same version.
+    try:
+        with stage("fetch_players"):
+            players = fetch_players()
     except Exception:
-        update_cache()
+        # When the player list cannot be fetched, remove all previous player information
+        # so that we do not display stale data.
+        players_version = time.time_ns()
+        update_cache([], players_version)
+        _publish_players([], players_version)
         raise
+    players_version = time.time_ns()
+    update_cache(players, players_version)
+    _publish_players(players, players_version)
 
 
-def _update_players():
-    run_player_pipeline(cache.world, cache.dfs, cache.LOCK)
+def _publish_players(players, players_version: int):
+    if _landscape_version is not None:
+        snapshot.publish_players(_landscape_version, players, players_version)
 
 
-Thread(target=_periodic, daemon=True).start()
+Thread(target=_boot, daemon=True).start()
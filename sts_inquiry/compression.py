@@ -0,0 +1,81 @@
+# Compresses large text responses for clients that accept it. Brotli is preferred if the optional brotli package is
+# installed; otherwise, gzip is used.
+
+import zlib
+from typing import List, Iterable, Iterator, Union
+
+from flask import request
+
+from sts_inquiry import app
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+_CODINGS = ["br", "gzip"] if brotli is not None else ["gzip"]
+_MIMETYPES = {"text/html", "application/json", "application/x-ndjson"}
+# Smaller responses would not get noticeably smaller.
+_MIN_SIZE = 1024
+
+
+def etag_variants(etag: str) -> List[str]:
+    # Each compressed representation of a response has its own strong ETag.
+    return [etag] + [f"{etag}-{coding}" for coding in _CODINGS]
+
+
+@app.after_request
+def compress(response):
+    if response.mimetype not in _MIMETYPES:
+        return response
+    response.vary.add("Accept-Encoding")
+    if response.status_code != 200 or response.direct_passthrough or "Content-Encoding" in response.headers:
+        return response
+
+    coding = request.accept_encodings.best_match(_CODINGS)
+    if coding is None:
+        return response
+
+    if response.is_streamed:
+        # Compress each chunk as soon as it comes in and pass it on right away.
+        response.response = _compress_stream(response.response, coding)
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < _MIN_SIZE:
+            return response
+        compressor = _Compressor(coding)
+        response.set_data(compressor.process(data) + compressor.finish())
+    response.headers["Content-Encoding"] = coding
+    etag, weak = response.get_etag()
+    if etag is not None:
+        response.set_etag(f"{etag}-{coding}", weak)
+    return response
+
+
+def _compress_stream(chunks: Iterable[Union[str, bytes]], coding: str) -> Iterator[bytes]:
+    compressor = _Compressor(coding)
+    for chunk in chunks:
+        compressed = compressor.process(chunk.encode() if isinstance(chunk, str) else chunk) + compressor.flush()
+        if compressed:
+            yield compressed
+    yield compressor.finish()
+
+
+class _Compressor:
+    # A common interface for the streaming compressors of gzip and brotli. Favors speed over size because every
+    # response is compressed anew.
+
+    def __init__(self, coding: str):
+        self._coding = coding
+        # wbits=31 produces the gzip format.
+        self._impl = brotli.Compressor(quality=4) if coding == "br" else zlib.compressobj(6, zlib.DEFLATED, 31)
+
+    def process(self, data: bytes) -> bytes:
+        return self._impl.process(data) if self._coding == "br" else self._impl.compress(data)
+
+    def flush(self) -> bytes:
+        return self._impl.flush() if self._coding == "br" else self._impl.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        return self._impl.finish() if self._coding == "br" else self._impl.flush(zlib.Z_FINISH)
@@ -1,9 +1,10 @@
+import re
 from dataclasses import dataclass, field as dfield
 from typing import List
 
 from flask_wtf import FlaskForm
 from markupsafe import Markup
-from wtforms import Field, BooleanField, StringField, SelectField, SubmitField
+from wtforms import Field, BooleanField, StringField, SelectField, SubmitField, ValidationError
 from wtforms.widgets import html_params
 
 from sts_inquiry.consts import INSTANCES
@@ -72,11 +73,19 @@ class RegionField(Field):
             return
 
 
+def _regex(form, field):
+    # The name fields are searched as regular expressions, see search._name_mask().
+    try:
+        re.compile(field.data or "")
+    except re.error as e:
+        raise ValidationError(f"Ungültiger regulärer Ausdruck: {e}")
+
+
 class SearchForm(FlaskForm):
     clustersize = SelectField("Clustergröße", coerce=int, default=1)
 
-    nameincl = StringField("Stellwerkname enthält")
-    nameexcl = StringField("Stellwerkname enthält nicht")
+    nameincl = StringField("Stellwerkname enthält", validators=[_regex])
+    nameexcl = StringField("Stellwerkname enthält nicht", validators=[_regex])
     regions = RegionField("Regionen")
     instance = SelectField("Instanz", coerce=int, default=-1,
                            choices=[(-1, "-- Alle -- ")] + [(inst, str(inst)) for inst in INSTANCES])
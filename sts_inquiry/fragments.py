@@ -0,0 +1,22 @@
+from dataclasses import dataclass
+from typing import Dict
+
+from markupsafe import Markup
+
+from sts_inquiry import app
+from sts_inquiry.structs import World
+
+
+@dataclass(frozen=True)
+class StwFragments:
+    # The HTML of the parts of each stw's box that only depend on the landscape, by aid.
+    # See templates/stw_fragments.html.
+    links: Dict[int, Markup]
+    tooltips: Dict[int, Markup]
+
+
+def render_stw_fragments(world: World) -> StwFragments:
+    # A popular stw appears in many rows of many pages, so render its static parts only once per landscape.
+    macros = app.jinja_env.get_template("stw_fragments.html").module
+    return StwFragments(links={stw.aid: macros.stw_link(stw) for stw in world.stws},
+                        tooltips={stw.aid: macros.stw_tooltip(stw) for stw in world.stws})
@@ -0,0 +1,245 @@
+# Counters, gauges and histograms about the pipeline and the request path, which are exposed in the Prometheus text
+# format on /metrics. Each process that serves the app keeps its own values. Only the updater process runs the landscape
+# and player pipelines, so it publishes its values of the updater metrics next to the snapshots, and all other processes
+# serve those instead of their own.
+
+import bisect
+import logging
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass
+from threading import Lock
+from typing import Dict, Tuple, List, Iterator, Iterable, Deque, TypeVar, Optional
+
+from sts_inquiry import app
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+T = TypeVar("T")
+
+_WINDOW = app.config["METRICS_WINDOW"]
+# Number of recent observations per series that the rolling quantiles are computed from.
+_WINDOW_SIZE = 4096
+_QUANTILES = (0.5, 0.9, 0.99)
+
+STAGE_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+REQUEST_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+log = logging.getLogger("sts-inquiry")
+
+_registry: List["_Metric"] = []
+
+
+class _Metric:
+    type_name = ""
+
+    def __init__(self, name: str, help_text: str, updater: bool):
+        self.name = name
+        self.help_text = help_text
+        # Whether the metric is about the work of the updater rather than the requests of this process.
+        self.updater = updater
+        self._lock = Lock()
+        _registry.append(self)
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} {self.type_name}"
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def __init__(self, name: str, help_text: str, updater: bool = False):
+        super().__init__(name, help_text, updater)
+        # By sorted label items.
+        self._values: Dict[Tuple[Tuple[str, str], ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> Iterator[str]:
+        yield from super().render()
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield f"{self.name}{_format_labels(key)} {_format_value(value)}"
+
+
+class Gauge(Counter):
+    type_name = "gauge"
+
+    def set(self, value: float, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    # Besides the cumulative buckets, it exposes quantiles of the observations within the last METRICS_WINDOW seconds
+    # as the summary {name}_recent, which shows the current latencies even after the process has been running for days.
+    type_name = "histogram"
+
+    def __init__(self, name: str, help_text: str, buckets: Tuple[float, ...], updater: bool = False):
+        super().__init__(name, help_text, updater)
+        self.buckets = buckets
+        # By sorted label items: the count per bucket (the last one is +Inf), the sum, and the recent observations.
+        self._series: Dict[Tuple[Tuple[str, str], ...], Tuple[List[int], List[float], Deque[Tuple[float, float]]]] = {}
+
+    def observe(self, value: float, **labels):
+        key = _label_key(labels)
+        now = time.monotonic()
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = ([0] * (len(self.buckets) + 1), [0.0], deque(maxlen=_WINDOW_SIZE))
+            counts, total, recent = series
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            total[0] += value
+            recent.append((now, value))
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def time_iter(self, items: Iterable[T], **labels) -> Iterator[T]:
+        # Only measures the time it takes to produce the items, not the time the consumer takes in between.
+        elapsed = 0.0
+        it = iter(items)
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(it)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed += time.perf_counter() - start
+                yield item
+        finally:
+            self.observe(elapsed, **labels)
+
+    def render(self) -> Iterator[str]:
+        yield from super().render()
+        cutoff = time.monotonic() - _WINDOW
+        with self._lock:
+            snapshot = [(key, list(counts), total[0], sorted(val for t, val in recent if t >= cutoff))
+                        for key, (counts, total, recent) in self._series.items()]
+        for key, counts, total, _ in snapshot:
+            cumulative = 0
+            for bound, count in zip([*map(_format_value, self.buckets), "+Inf"], counts):
+                cumulative += count
+                yield f"{self.name}_bucket{_format_labels(key + (('le', bound),))} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(key)} {_format_value(total)}"
+            yield f"{self.name}_count{_format_labels(key)} {cumulative}"
+
+        yield f"# HELP {self.name}_recent {self.help_text} (last {_WINDOW} seconds)"
+        yield f"# TYPE {self.name}_recent summary"
+        for key, _, _, recent in snapshot:
+            if recent:
+                for q in _QUANTILES:
+                    value = recent[min(len(recent) - 1, int(q * len(recent)))]
+                    yield f"{self.name}_recent{_format_labels(key + (('quantile', str(q)),))} {_format_value(value)}"
+            yield f"{self.name}_recent_sum{_format_labels(key)} {_format_value(sum(recent))}"
+            yield f"{self.name}_recent_count{_format_labels(key)} {len(recent)}"
+
+
+STAGE_SECONDS = Histogram("sts_inquiry_stage_seconds", "Wall time of the pipeline stages.", STAGE_BUCKETS,
+                          updater=True)
+STAGE_CPU_SECONDS = Counter("sts_inquiry_stage_cpu_seconds_total",
+                            "CPU time of the whole process while the pipeline stages were running.", updater=True)
+STAGE_PEAK_RSS_BYTES = Gauge("sts_inquiry_stage_peak_rss_increase_bytes",
+                             "How much the peak resident memory of the process grew during the last run of a stage.",
+                             updater=True)
+STAGE_FAILURES = Counter("sts_inquiry_stage_failures_total", "Runs of the pipeline stages that raised an exception.",
+                         updater=True)
+CLUSTERS = Gauge("sts_inquiry_clusters", "Number of clusters of each size in the current landscape.", updater=True)
+FETCH_REQUESTS = Counter("sts_inquiry_fetch_requests_total", "HTTP requests sent to the Sts website by status code.",
+                         updater=True)
+FETCH_BYTES = Counter("sts_inquiry_fetch_bytes_total",
+                      "Bytes of the response bodies received from the Sts website, as transferred (e.g., compressed).",
+                      updater=True)
+FETCH_RELOGINS = Counter("sts_inquiry_fetch_relogins_total",
+                         "Player list fetches that had to be repeated after logging in again.", updater=True)
+UPDATES = Counter("sts_inquiry_cache_updates_total", "Cache updates by kind and outcome.", updater=True)
+SEARCH_SECONDS = Histogram("sts_inquiry_search_seconds", "Time spent in each phase of answering a search.",
+                           REQUEST_BUCKETS)
+SEARCH_CACHE = Gauge("sts_inquiry_search_cache", "Statistics of the cache of recent search rankings.")
+REQUEST_SECONDS = Histogram("sts_inquiry_request_seconds", "Time until a response has been sent completely.",
+                            REQUEST_BUCKETS)
+
+
+@dataclass(frozen=True)
+class StageRun:
+    wall: float
+    cpu: float
+    peak_rss_increase: int
+
+
+# The last run of each stage, by name.
+_last_runs: Dict[str, StageRun] = {}
+
+
+@contextmanager
+def stage(name: str):
+    wall_start, cpu_start, rss_start = time.perf_counter(), time.process_time(), _peak_rss()
+    try:
+        yield
+    except BaseException:
+        STAGE_FAILURES.inc(stage=name)
+        raise
+    finally:
+        run = StageRun(wall=time.perf_counter() - wall_start, cpu=time.process_time() - cpu_start,
+                       peak_rss_increase=_peak_rss() - rss_start)
+        _last_runs[name] = run
+        STAGE_SECONDS.observe(run.wall, stage=name)
+        STAGE_CPU_SECONDS.inc(run.cpu, stage=name)
+        STAGE_PEAK_RSS_BYTES.set(run.peak_rss_increase, stage=name)
+        log.info(" * Stage %s took %.2fs (%.2fs CPU).", name, run.wall, run.cpu)
+
+
+def last_stage_runs() -> Dict[str, StageRun]:
+    return dict(_last_runs)
+
+
+def count_response(resp, *_args, **_kwargs):
+    # A response hook for requests sessions. Hooks run before the body has been read, so read it now and count the
+    # bytes that came over the wire, which are fewer than those of the content if the response was compressed.
+    FETCH_REQUESTS.inc(status=str(resp.status_code))
+    _ = resp.content
+    FETCH_BYTES.inc(resp.raw.tell())
+
+
+def render(updater: Optional[bool] = None) -> str:
+    # Renders all metrics, or only the updater metrics resp. only the others.
+    return "".join(line + "\n" for metric in _registry if updater is None or metric.updater == updater
+                   for line in metric.render())
+
+
+def _peak_rss() -> int:
+    # ru_maxrss is in KiB on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 if resource is not None else 0
+
+
+def _label_key(labels: Dict[str, str]) -> Tuple[Tuple[str, str], ...]:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _format_labels(key: Tuple[Tuple[str, str], ...]) -> str:
+    if not key:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for _, value in key)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(key, escaped)) + "}"
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
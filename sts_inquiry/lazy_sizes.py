@@ -0,0 +1,236 @@
+# The landscape pipeline only computes the cluster sizes up to EAGER_CLUSTER_SIZE, so that the site is available as
+# soon as the small sizes are ready. The larger sizes are None in the cached state until they are materialized here.
+# Only the updater computes them: once it serves a new landscape, it materializes them one after another in the
+# background, patching the sizes of the previous landscape where possible, and adds each of them to the published
+# snapshot, from which the followers map it into memory on their next poll. Searches never wait for a size; until it is
+# available, they are answered with 503 and asked to retry (see views).
+# LAZY_MEMORY_BUDGET bounds the memory of the materialized large sizes by evicting the least recently searched ones.
+# The next search for an evicted size loads it from the snapshot again, or, without snapshots, computes it again.
+
+import logging
+import time
+from threading import Lock, Thread
+from typing import Dict, Tuple, Optional, List, Set, Any
+
+import pandas as pd
+
+from sts_inquiry import app, cache, snapshot
+from sts_inquiry.cache import State
+from sts_inquiry.pipeline import run_cluster_size_pipeline, patch_cluster_size_pipeline, apply_occupants
+from sts_inquiry.structs import ClusterIndex, World
+
+_MAX_CLUSTER_SIZE = app.config["MAX_CLUSTER_SIZE"]
+_EAGER_CLUSTER_SIZE = min(app.config["EAGER_CLUSTER_SIZE"] or _MAX_CLUSTER_SIZE, _MAX_CLUSTER_SIZE)
+_MEMORY_BUDGET = app.config["LAZY_MEMORY_BUDGET"] << 20
+
+log = logging.getLogger("sts-inquiry")
+
+# Each size is only materialized by one thread at a time.
+_size_locks = {cluster_size: Lock() for cluster_size in range(1, _MAX_CLUSTER_SIZE + 1)}
+# When each lazy size has last been searched for, by size.
+_last_used: Dict[int, float] = {}
+# Approximate number of bytes of each materialized lazy size, by size.
+_footprints: Dict[int, int] = {}
+# The (landscape version, size) pairs that have been evicted and are only loaded again when they are searched for.
+_evicted: Set[Tuple[str, int]] = set()
+# The world that this process computes the lazy sizes of because it is the updater, and the snapshot version that they
+# are added to (if it has been published).
+_computed: Optional[Tuple[World, Optional[str]]] = None
+# The sizes that searches are waiting for and that a background thread is already materializing.
+_requested: Set[int] = set()
+_requested_lock = Lock()
+
+
+def available(state: State, cluster_size: Any) -> bool:
+    # Returns whether the given state has the given cluster size. If not, the size is materialized in the background,
+    # so the caller should ask the client to retry in a while.
+    if not isinstance(cluster_size, int) or not 1 <= cluster_size <= len(state.dfs):
+        return True
+    if cluster_size > _EAGER_CLUSTER_SIZE:
+        _last_used[cluster_size] = time.monotonic()
+    if state.dfs[cluster_size - 1] is not None:
+        return True
+    _evicted.discard((state.landscape_version, cluster_size))
+    # Followers load the size on their next poll once the updater has published it (see load_published()).
+    if _computed is not None and _computed[0] is state.world:
+        with _requested_lock:
+            if cluster_size in _requested:
+                return False
+            _requested.add(cluster_size)
+        Thread(target=_materialize_requested, args=(state, cluster_size), daemon=True).start()
+    return False
+
+
+def materialize_in_background(world: World, snapshot_version: Optional[str], prev: Optional[State] = None):
+    # Only the updater calls this, whenever it serves a new landscape or has taken over from another updater. The
+    # previous state, if given, is the one that the new landscape has replaced.
+    global _computed
+    _computed = world, snapshot_version
+    if _EAGER_CLUSTER_SIZE < _MAX_CLUSTER_SIZE:
+        Thread(target=_materialize_all, args=(world, prev), daemon=True).start()
+
+
+def load_published():
+    # The followers call this on every poll to map the sizes that the updater has published since into memory.
+    state = cache.get()
+    if state is None or not snapshot.enabled():
+        return
+    for cluster_size in range(_EAGER_CLUSTER_SIZE + 1, len(state.dfs) + 1):
+        if state.dfs[cluster_size - 1] is None and (state.landscape_version, cluster_size) not in _evicted:
+            _materialize_and_evict(state, cluster_size)
+
+
+def _materialize_requested(state: State, cluster_size: int):
+    try:
+        _materialize_and_evict(state, cluster_size)
+    finally:
+        with _requested_lock:
+            _requested.discard(cluster_size)
+
+
+def _materialize_all(world: World, prev: Optional[State]):
+    for cluster_size in range(_EAGER_CLUSTER_SIZE + 1, _MAX_CLUSTER_SIZE + 1):
+        # Stop when a newer landscape has arrived, which starts its own thread.
+        state = cache.get()
+        if state is None or state.world is not world:
+            return
+        if state.dfs[cluster_size - 1] is None:
+            _materialize_and_evict(state, cluster_size, prev)
+
+
+def _materialize_and_evict(state: State, cluster_size: int, prev: Optional[State] = None):
+    try:
+        _materialize(state, cluster_size, prev)
+    except Exception as e:
+        log.exception("Failed to materialize the clusters of size %d: %s: %s", cluster_size, e.__class__.__name__, e)
+        return
+    _evict(cluster_size)
+
+
+def _materialize(state: State, cluster_size: int, prev: Optional[State]):
+    with _size_locks[cluster_size]:
+        # Another thread might have materialized the size while we were waiting.
+        if _cached(state.world, cluster_size) is not None:
+            return
+
+        loaded = snapshot.load_cluster_size(state.landscape_version, cluster_size) if snapshot.enabled() else None
+        if loaded is not None:
+            df, index = loaded
+        elif _computed is not None and _computed[0] is state.world:
+            df, index = _compute(state, cluster_size, prev)
+            snapshot_version = _computed[1]
+            if snapshot_version is not None:
+                df, index = _publish(snapshot_version, cluster_size, df, index)
+        else:
+            # Followers wait for the updater to publish the size.
+            return
+        _footprints[cluster_size] = _footprint(df, index)
+
+        # Player updates only replace the occupancy of the cached state, so retry until the size has been added to
+        # the latest one or the landscape has changed.
+        while True:
+            current = cache.get()
+            if current is None or current.world is not state.world or current.dfs[cluster_size - 1] is not None:
+                return
+            if cache.replace(current, **_with_size(current, cluster_size, df, index)) is not None:
+                return
+
+
+def _compute(state: State, cluster_size: int, prev: Optional[State]) -> Tuple[pd.DataFrame, ClusterIndex]:
+    # Patches the same size of the previous landscape if it is still at hand, since that is much cheaper.
+    prev_df = None
+    if prev is not None:
+        prev_df = prev.dfs[cluster_size - 1]
+        if prev_df is None and snapshot.enabled():
+            prev_df = (snapshot.load_cluster_size(prev.landscape_version, cluster_size) or (None, None))[0]
+
+    log.info(" * Materializing the clusters of size %d...", cluster_size)
+    if prev_df is not None:
+        df, index = patch_cluster_size_pipeline(state.world, prev.world, prev_df, cluster_size)
+    else:
+        df, index = run_cluster_size_pipeline(state.world, cluster_size)
+    log.info(" * Finished materializing %d clusters of size %d.", len(df), cluster_size)
+    return df, index
+
+
+def _publish(snapshot_version: str, cluster_size: int, df: pd.DataFrame, index: ClusterIndex) \
+        -> Tuple[pd.DataFrame, ClusterIndex]:
+    # Adds the size to the snapshot and returns it memory-mapped, so that this process shares it with the followers.
+    try:
+        # The occupancy tables come first so that followers find them as soon as they see the size.
+        state = cache.get()
+        players = snapshot.load_players()
+        if players is not None and players["landscape_version"] == snapshot_version and \
+                str(players["version"]) == state.players_version:
+            occ = apply_occupants(state.world, df, cluster_size, state.occupants)
+            snapshot.publish_occupancy(snapshot_version, players["version"], [None] * (cluster_size - 1) + [occ])
+        snapshot.publish_cluster_size(snapshot_version, cluster_size, df, index)
+        return snapshot.load_cluster_size(snapshot_version, cluster_size) or (df, index)
+    except Exception as e:
+        # The followers then keep waiting for the size, but at least this process can serve it.
+        log.exception(" * Failed to publish the clusters of size %d: %s: %s", cluster_size, e.__class__.__name__, e)
+        return df, index
+
+
+def _cached(world: World, cluster_size: int) -> Optional[pd.DataFrame]:
+    current = cache.get()
+    if current is None or current.world is not world:
+        return None
+    return current.dfs[cluster_size - 1]
+
+
+def _with_size(state: State, cluster_size: int, df: Optional[pd.DataFrame], index: Optional[ClusterIndex]) \
+        -> Dict[str, tuple]:
+    # Returns the fields of the given state that change when the given size is replaced.
+    occ = None
+    if df is not None:
+        occ = _occupancy(state, cluster_size, df)
+    pos = cluster_size - 1
+    return {"dfs": state.dfs[:pos] + (df,) + state.dfs[pos + 1:],
+            "indexes": state.indexes[:pos] + (index,) + state.indexes[pos + 1:],
+            "occupancy": state.occupancy[:pos] + (occ,) + state.occupancy[pos + 1:]}
+
+
+def _occupancy(state: State, cluster_size: int, df: pd.DataFrame) -> pd.DataFrame:
+    # Prefers the table that the updater has published for the players of the given state.
+    if snapshot.enabled():
+        occ = snapshot.load_occupancy(state.landscape_version, state.players_version,
+                                      [None] * (cluster_size - 1) + [df])[-1]
+        if occ is not None:
+            return occ
+    return apply_occupants(state.world, df, cluster_size, state.occupants)
+
+
+def _evict(keep: int):
+    # Evicts the least recently searched lazy sizes, except the given one, until the budget is met. Searches that
+    # still use an evicted size keep it alive until they have finished.
+    if not _MEMORY_BUDGET:
+        return
+    while True:
+        state = cache.get()
+        if _used_bytes(state) <= _MEMORY_BUDGET:
+            return
+        candidates = [cluster_size for cluster_size in _lazy_sizes(state) if cluster_size != keep]
+        if not candidates:
+            return
+        victim = min(candidates, key=lambda cluster_size: _last_used.get(cluster_size, 0))
+        if cache.replace(state, **_with_size(state, victim, None, None)) is not None:
+            _footprints.pop(victim, None)
+            _evicted.add((state.landscape_version, victim))
+            log.info(" * Evicted the clusters of size %d to stay within the memory budget.", victim)
+
+
+def _lazy_sizes(state: State) -> List[int]:
+    # The sizes above EAGER_CLUSTER_SIZE that are materialized in the given state.
+    return [cluster_size for cluster_size in range(_EAGER_CLUSTER_SIZE + 1, len(state.dfs) + 1)
+            if state.dfs[cluster_size - 1] is not None]
+
+
+def _used_bytes(state: State) -> int:
+    return sum(_footprints.get(cluster_size, 0) for cluster_size in _lazy_sizes(state))
+
+
+def _footprint(df: pd.DataFrame, index: ClusterIndex) -> int:
+    return int(df.memory_usage(deep=True).sum()) + index.indptr.nbytes + index.cids.nbytes + \
+        sum(cids.nbytes for cids in index.sorted_cids.values()) + index.region_indptr.nbytes + \
+        index.region_cids.nbytes
@@ -1,36 +1,96 @@
-from threading import Lock
-from typing import Optional, List, Tuple
+import logging
+from typing import Optional, List, Tuple, Sequence, Dict
 
+import numpy as np
 import pandas as pd
 
-from sts_inquiry.structs import World
-from .a_fetch import fetch_landscape, fetch_players
-from .b_link import link_landscape, link_players
-from .c_cluster import cluster_landscape
-from .d_metrics import landscape_metrics, player_metrics
-
-
-def run_landscape_pipeline() -> Tuple[World, List[pd.DataFrame]]:
-    world = link_landscape(*fetch_landscape())
-    return world, list(landscape_metrics(cluster_landscape(world)))
-
-
-def run_player_pipeline(world: World, dfs: List[pd.DataFrame], lock: Optional[Lock]):
-    def process_fetched_players(players):
-        if lock is not None:
-            with lock:
-                link_players(world, players)
-                player_metrics(dfs)
-        else:
-            link_players(world, players)
-            player_metrics(dfs)
-
-    try:
-        fetched_players = fetch_players()
-    except Exception:
-        # When the player list cannot be fetched, remove all previous player information
-        # so that we do not display stale data.
-        process_fetched_players([])
-        raise
-
-    process_fetched_players(fetched_players)
+from sts_inquiry import app
+from sts_inquiry.consts import INSTANCES
+from sts_inquiry.instrumentation import stage, CLUSTERS
+from sts_inquiry.structs import World, ClusterIndex, Player
+from .a_fetch import fetch_landscape
+from .a_fetch.player_fetcher import PlayerPrototype
+from .b_link import link_landscape, link_players, occupancy, diff_landscape
+from .c_cluster import cluster_landscape, cluster_around
+from .d_metrics import landscape_metrics, patch_landscape_metrics, cluster_index, player_metrics, \
+    cluster_size_metrics
+
+_MAX_CLUSTER_SIZE = app.config["MAX_CLUSTER_SIZE"]
+_EAGER_CLUSTER_SIZE = min(app.config["EAGER_CLUSTER_SIZE"] or _MAX_CLUSTER_SIZE, _MAX_CLUSTER_SIZE)
+
+log = logging.getLogger("sts-inquiry")
+
+
+def run_landscape_pipeline(prev_world: Optional[World] = None,
+                           prev_dfs: Optional[Sequence[Optional[pd.DataFrame]]] = None) \
+        -> Tuple[World, List[Optional[pd.DataFrame]], List[Optional[ClusterIndex]]]:
+    # Only the cluster sizes up to EAGER_CLUSTER_SIZE are computed; the larger ones are None and left to lazy_sizes.
+    # This also holds when patching, so the result never depends on which sizes happen to be materialized.
+    with stage("fetch_landscape"):
+        protos = fetch_landscape()
+    with stage("link_landscape"):
+        world = link_landscape(*protos)
+
+    # If we know the previous landscape, only recompute the clusters that contain stws which have changed since then.
+    if prev_world is not None and prev_dfs is not None and all(df is not None for df in prev_dfs[:_EAGER_CLUSTER_SIZE]):
+        changed_aids = diff_landscape(prev_world, world)
+        log.info(" * %d stws have changed since the previous landscape.", len(changed_aids))
+        prev_dfs = list(prev_dfs[:_EAGER_CLUSTER_SIZE]) + [None] * (_MAX_CLUSTER_SIZE - _EAGER_CLUSTER_SIZE)
+        with stage("cluster_landscape"):
+            changed_clusters = cluster_around(world, changed_aids, _EAGER_CLUSTER_SIZE)
+        with stage("landscape_metrics"):
+            dfs = list(patch_landscape_metrics(world, prev_world, prev_dfs, changed_aids, changed_clusters))
+    else:
+        with stage("cluster_landscape"):
+            all_clusters = cluster_landscape(world, _EAGER_CLUSTER_SIZE)
+        with stage("landscape_metrics"):
+            dfs = list(landscape_metrics(world, all_clusters)) + [None] * (_MAX_CLUSTER_SIZE - _EAGER_CLUSTER_SIZE)
+
+    with stage("cluster_index"):
+        indexes = [cluster_index(world, df, cluster_size) if df is not None else None
+                   for cluster_size, df in enumerate(dfs, start=1)]
+    for cluster_size, df in enumerate(dfs, start=1):
+        if df is not None:
+            CLUSTERS.set(len(df), cluster_size=cluster_size)
+
+    return world, dfs, indexes
+
+
+def run_cluster_size_pipeline(world: World, cluster_size: int) -> Tuple[pd.DataFrame, ClusterIndex]:
+    # Computes the df and index of a single cluster size that run_landscape_pipeline() has left out. Enumerating the
+    # clusters of a size still requires enumerating all smaller ones, which are then thrown away.
+    with stage("cluster_size_pipeline"):
+        all_clusters = cluster_landscape(world, cluster_size)
+        df = cluster_size_metrics(world, all_clusters[-1], cluster_size)
+        index = cluster_index(world, df, cluster_size)
+    CLUSTERS.set(len(df), cluster_size=cluster_size)
+    return df, index
+
+
+def patch_cluster_size_pipeline(world: World, prev_world: World, prev_df: pd.DataFrame, cluster_size: int) \
+        -> Tuple[pd.DataFrame, ClusterIndex]:
+    # Same as run_cluster_size_pipeline(), but only recomputes the clusters that contain stws which have changed since
+    # the given previous world, whose df of the same cluster size is given.
+    with stage("cluster_size_pipeline"):
+        changed_aids = diff_landscape(prev_world, world)
+        changed_clusters = cluster_around(world, changed_aids, cluster_size)
+        df = list(patch_landscape_metrics(world, prev_world, [None] * (cluster_size - 1) + [prev_df],
+                                          changed_aids, changed_clusters))[-1]
+        index = cluster_index(world, df, cluster_size)
+    CLUSTERS.set(len(df), cluster_size=cluster_size)
+    return df, index
+
+
+def apply_players(world: World, dfs: Sequence[Optional[pd.DataFrame]], players: List[PlayerPrototype]) \
+        -> Tuple[List[Optional[pd.DataFrame]], Dict[Tuple[int, int], Player]]:
+    # Returns the occupancy table of each df for the given players, as well as the occupants of the stws.
+    with stage("player_metrics"):
+        return player_metrics(world, dfs, occupancy(world, players)), link_players(world, players)
+
+
+def apply_occupants(world: World, df: pd.DataFrame, cluster_size: int, occupants: Dict[Tuple[int, int], Player]) \
+        -> pd.DataFrame:
+    # Returns the occupancy table of a single df for the players that are already linked to the world.
+    occupied = np.stack([np.isin(world.graph.aids, [aid for aid, instance in occupants if instance == inst])
+                         for inst in INSTANCES])
+    return player_metrics(world, [None] * (cluster_size - 1) + [df], occupied)[-1]
@@ -0,0 +1,126 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, TypeVar
+from urllib.parse import urlsplit
+
+import requests
+
+from sts_inquiry.instrumentation import count_response
+from sts_inquiry.pipeline.a_fetch.response_store import ResponseStore, StoredResponse, content_hash
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+log = logging.getLogger("sts-inquiry")
+
+
+class FetchEngine:
+    # Performs GET requests from a bounded thread pool.
+    # At most max_in_flight requests are running at the same time, and requests to the same host are started
+    # at most rate_limit times per second (a rate limit of 0 disables throttling).
+    # Each worker thread uses its own session because sessions are not guaranteed to be thread-safe.
+    # If a response store is given, get_content() sends conditional requests based on the stored responses.
+
+    def __init__(self, user_agent: str, timeout: float, max_in_flight: int, rate_limit: float,
+                 store: Optional[ResponseStore] = None):
+        self._user_agent = user_agent
+        self._timeout = timeout
+        self._max_in_flight = max(1, max_in_flight)
+        self._min_interval = 1 / rate_limit if rate_limit > 0 else 0
+
+        self._executor = ThreadPoolExecutor(max_workers=self._max_in_flight, thread_name_prefix="sts-fetch")
+        self._in_flight = threading.BoundedSemaphore(self._max_in_flight)
+        self._local = threading.local()
+        self._store = store
+
+        self._throttle_lock = threading.Lock()
+        self._next_slots: Dict[str, float] = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        self._throttle(urlsplit(url).netloc)
+        with self._in_flight:
+            return self._session().get(url, timeout=self._timeout, **kwargs)
+
+    def get_content(self, url: str) -> Tuple[bytes, Optional[str]]:
+        # Returns the content behind the URL and its hash, which tells whether the content is the same as that of an
+        # earlier fetch. Unsuccessful responses are never stored and have no hash.
+        if self._store is None:
+            resp = self.get(url)
+            return resp.content, content_hash(resp.content) if resp.status_code == 200 else None
+
+        stored = self._store.load(url)
+        headers = {}
+        if stored is not None:
+            if stored.etag:
+                headers["If-None-Match"] = stored.etag
+            if stored.last_modified:
+                headers["If-Modified-Since"] = stored.last_modified
+
+        resp = self.get(url, headers=headers)
+        if resp.status_code == 304 and stored is not None:
+            return stored.content, stored.content_hash
+        if resp.status_code != 200:
+            return resp.content, None
+
+        new_hash = content_hash(resp.content)
+        if stored is None or stored.content_hash != new_hash or stored.etag != resp.headers.get("ETag") or \
+                stored.last_modified != resp.headers.get("Last-Modified"):
+            self._store.save(StoredResponse(url=url, etag=resp.headers.get("ETag"),
+                                            last_modified=resp.headers.get("Last-Modified"),
+                                            content_hash=new_hash, content=resp.content))
+        return resp.content, new_hash
+
+    def map(self, fn: Callable[[T], R], items: Iterable[T], progress_label: Optional[str] = None) -> List[R]:
+        # Applies fn to all items concurrently and returns the results in the order of the items.
+        # If any call raises, the remaining calls are cancelled and the exception of the first failed item
+        # (in item order) is re-raised, just like a sequential loop would do.
+        items = list(items)
+        n_done = 0
+        n_done_lock = threading.Lock()
+
+        def task(item):
+            nonlocal n_done
+            result = fn(item)
+            if progress_label is not None:
+                with n_done_lock:
+                    n_done += 1
+                    if n_done % 50 == 0:
+                        log.info(" *  * Fetched %d of %d %s.", n_done, len(items), progress_label)
+            return result
+
+        futures = [self._executor.submit(task, item) for item in items]
+        try:
+            return [future.result() for future in futures]
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def _session(self) -> requests.Session:
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = requests.Session()
+            session.headers["User-Agent"] = self._user_agent
+            session.hooks["response"].append(count_response)
+            self._local.session = session
+        return session
+
+    def _throttle(self, host: str):
+        if not self._min_interval:
+            return
+        with self._throttle_lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slots.get(host, now))
+            self._next_slots[host] = slot + self._min_interval
+        if slot > now:
+            time.sleep(slot - now)
@@ -3,49 +3,63 @@ from __future__ import annotations
 import json
 import logging
 import re
-from dataclasses import dataclass
-from typing import Iterator, Tuple, List, Set
+from dataclasses import dataclass, replace
+from typing import Iterator, Tuple, List, Set, Dict, Optional
 from urllib.parse import urljoin
 
-import requests
 from lxml import html
 from markupsafe import Markup
 
 from sts_inquiry import app
 from sts_inquiry.consts import PLAYING_DURATION_CONVERSION
+from sts_inquiry.pipeline.a_fetch.fetch_engine import FetchEngine
+from sts_inquiry.pipeline.a_fetch.response_store import ResponseStore
 from sts_inquiry.structs import Comment
 
 _STS_URL = app.config["STS_URL"]
 _USER_AGENT = app.config["FETCH_USER_AGENT"]
 _TIMEOUT = app.config["FETCH_TIMEOUT"]
+_MAX_IN_FLIGHT = app.config["FETCH_MAX_IN_FLIGHT"]
+_RATE_LIMIT = app.config["FETCH_RATE_LIMIT"]
+_RESPONSE_STORE_DIR = app.config["FETCH_RESPONSE_STORE_DIR"]
 
 log = logging.getLogger("sts-inquiry")
 
+# The stws parsed by the last successful landscape fetch together with the hashes of their stw and forum responses,
+# by aid. Stws whose responses still have the same hashes are reused. The response store cannot tell this on its own:
+# when a fetch fails halfway, the store already holds the new responses while these are still the old stws.
+_prev_stw_protos: Dict[int, Tuple[StwPrototype, Optional[str], Optional[str]]] = {}
+
 
 def fetch_landscape() -> Tuple[List[SuperRegionPrototype], List[RegionPrototype],
                                Set[EdgePrototype], List[StwPrototype]]:
-    session = requests.Session()
-    session.headers["User-Agent"] = _USER_AGENT
-
-    log.info(" * Fetching super regions and region rids...")
-    superregion_protos, region_protos = _fetch_rids(session)
-    if len(region_protos) == 0:
-        raise ValueError("No regions found.")
-
-    log.info(" * Fetching region maps for %d regions...", len(region_protos))
-    aids = set()
-    edge_protos = set()
-    for region_proto in region_protos:
-        r_aids, r_edge_protos = _fetch_region_map(session, region_proto.rid)
-        aids.update(r_aids)
-        edge_protos.update(r_edge_protos)
-
-    log.info(" * Fetching %d stws...", len(aids))
-    stw_protos = []
-    for ctr, aid in enumerate(aids):
-        stw_protos.append(_fetch_stw(session, aid))
-        if (ctr + 1) % 50 == 0:
-            log.info(" *  * Fetched %d of %d stws.", ctr + 1, len(aids))
+    global _prev_stw_protos
+
+    store = ResponseStore(_RESPONSE_STORE_DIR) if _RESPONSE_STORE_DIR else None
+    with FetchEngine(_USER_AGENT, _TIMEOUT, _MAX_IN_FLIGHT, _RATE_LIMIT, store) as engine:
+        log.info(" * Fetching super regions and region rids...")
+        superregion_protos, region_protos = _fetch_rids(engine)
+        if len(region_protos) == 0:
+            raise ValueError("No regions found.")
+
+        log.info(" * Fetching region maps for %d regions...", len(region_protos))
+        aids = set()
+        edge_protos = set()
+        for r_aids, r_edge_protos in engine.map(lambda proto: _fetch_region_map(engine, proto.rid), region_protos):
+            aids.update(r_aids)
+            edge_protos.update(r_edge_protos)
+
+        log.info(" * Fetching %d stws with up to %d concurrent requests...", len(aids), _MAX_IN_FLIGHT)
+        stw_results = engine.map(lambda aid: _fetch_stw(engine, aid), aids, progress_label="stws")
+        stw_protos = [stw_proto for stw_proto, _, _, _ in stw_results]
+
+    n_unchanged = sum(reused for _, _, _, reused in stw_results)
+    n_added = sum(aid not in _prev_stw_protos for aid in aids)
+    n_removed = sum(aid not in aids for aid in _prev_stw_protos)
+    log.info(" * Compared to the last fetch, %d stws are unchanged, %d updated, %d added, and %d removed.",
+             n_unchanged, len(aids) - n_unchanged - n_added, n_added, n_removed)
+    _prev_stw_protos = {stw_proto.aid: (stw_proto, stw_hash, forum_hash)
+                        for stw_proto, stw_hash, forum_hash, _ in stw_results}
 
     log.info(" * Finished fetching raw landscape information.")
 
@@ -55,9 +69,9 @@ def fetch_landscape() -> Tuple[List[SuperRegionPrototype], List[RegionPrototype]
 
 # ========== MAIN PAGE ==========
 
-def _fetch_rids(session: requests.Session) -> Tuple[List[SuperRegionPrototype], List[RegionPrototype]]:
-    resp = session.get(urljoin(_STS_URL, "anlagen.php"), timeout=_TIMEOUT)
-    page = html.fromstring(resp.content)
+def _fetch_rids(engine: FetchEngine) -> Tuple[List[SuperRegionPrototype], List[RegionPrototype]]:
+    content, _ = engine.get_content(urljoin(_STS_URL, "anlagen.php"))
+    page = html.fromstring(content)
 
     superregion_protos = []
     for superregion_node in page.xpath("//td[@class='border1']/a"):
@@ -79,9 +93,9 @@ def _fetch_rids(session: requests.Session) -> Tuple[List[SuperRegionPrototype],
 
 # ========== REGION MAP JSON ==========
 
-def _fetch_region_map(session: requests.Session, rid: int) -> Tuple[List[int], List[EdgePrototype]]:
-    resp = session.get(urljoin(_STS_URL, f"landschaft-data.php?rid={rid}"), timeout=_TIMEOUT)
-    data = json.loads(resp.text)
+def _fetch_region_map(engine: FetchEngine, rid: int) -> Tuple[List[int], List[EdgePrototype]]:
+    content, _ = engine.get_content(urljoin(_STS_URL, f"landschaft-data.php?rid={rid}"))
+    data = json.loads(content)
 
     kids_to_aids = {}
     for node in data["knoten"]:
@@ -106,9 +120,27 @@ def _fetch_region_map(session: requests.Session, rid: int) -> Tuple[List[int], L
 
 # ========== SINGLE STW ==========
 
-def _fetch_stw(session: requests.Session, aid: int) -> StwPrototype:
-    resp = session.get(urljoin(_STS_URL, f"anlagen.php?subdata=ajax&m=anlage&aid={aid}"), timeout=_TIMEOUT)
-    data = json.loads(resp.text)
+def _fetch_stw(engine: FetchEngine, aid: int) -> Tuple[StwPrototype, Optional[str], Optional[str], bool]:
+    # Returns the stw, the hashes of its stw and forum responses, and whether it could be reused from the last
+    # successful fetch because both responses still have the same hashes.
+    content, stw_hash = engine.get_content(urljoin(_STS_URL, f"anlagen.php?subdata=ajax&m=anlage&aid={aid}"))
+    prev_proto, prev_stw_hash, prev_forum_hash = _prev_stw_protos.get(aid, (None, None, None))
+    proto = prev_proto if stw_hash is not None and stw_hash == prev_stw_hash else _parse_stw(aid, content)
+
+    forum_hash = None
+    if proto.forum_id:
+        content, forum_hash = engine.get_content(urljoin(_STS_URL, f"forum/viewtopic.php?t={proto.forum_id}"))
+        if forum_hash is None or forum_hash != prev_forum_hash or prev_proto.forum_id != proto.forum_id:
+            # Reverse the comments so that the newest ones are right at the top.
+            proto = replace(proto, comments=list(reversed(list(_parse_comments(content)))))
+        elif proto is not prev_proto:
+            proto = replace(proto, comments=prev_proto.comments)
+
+    return proto, stw_hash, forum_hash, proto is prev_proto
+
+
+def _parse_stw(aid: int, content: bytes) -> StwPrototype:
+    data = json.loads(content)
 
     assert aid == int(data["aid"]), f"Stw aid in url {aid} doesn't match returned aid {data['aid']}."
 
@@ -124,14 +156,10 @@ def _fetch_stw(session: requests.Session, aid: int) -> StwPrototype:
 
     difficulty, entertainment, forum_id = _stw_parse_voting(data["voting"])
 
-    comments = []
-    if forum_id:
-        # Reverse the comments so that the newest ones are right at the top.
-        comments = list(reversed(list(_fetch_comments(session, forum_id))))
-
+    # The comments are filled in later from the forum thread.
     return StwPrototype(aid=aid, rid=rid,
                         name=name, description=desc, latitude=latitude, longitude=longitude,
-                        difficulty=difficulty, entertainment=entertainment, comments=comments)
+                        difficulty=difficulty, entertainment=entertainment, forum_id=forum_id, comments=[])
 
 
 def _stw_parse_voting(voting: str):
@@ -154,9 +182,8 @@ def _stw_parse_voting(voting: str):
 # ========== COMMENT FORUM FOR SINGLE STW ==========
 
 
-def _fetch_comments(session: requests.Session, forum_id: str) -> Iterator[Comment]:
-    resp = session.get(urljoin(_STS_URL, f"forum/viewtopic.php?t={forum_id}"), timeout=_TIMEOUT)
-    page = html.fromstring(resp.content)
+def _parse_comments(content: bytes) -> Iterator[Comment]:
+    page = html.fromstring(content)
 
     # Note: We skip the first comment since it's just saying that this thread is a shoutbox.
     posts = [(post.xpath(".//div[@class='content']/text()"),
@@ -205,4 +232,5 @@ class StwPrototype:
 
     difficulty: float
     entertainment: float
+    forum_id: Optional[str]
     comments: List[Comment]
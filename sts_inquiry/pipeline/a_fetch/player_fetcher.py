@@ -5,13 +5,14 @@ import logging
 import time
 from dataclasses import dataclass
 from datetime import datetime
-from typing import Optional, Iterator
+from typing import List, Optional, Iterator
 from urllib.parse import urljoin
 
 import requests
 from lxml import html
 
 from sts_inquiry import app
+from sts_inquiry.instrumentation import count_response, FETCH_RELOGINS
 
 _STS_URL = app.config["STS_URL"]
 _USER_AGENT = app.config["FETCH_USER_AGENT"]
@@ -35,6 +36,7 @@ def fetch_players() -> List[PlayerPrototype]:
 
     session = requests.Session()
     session.headers["User-Agent"] = _USER_AGENT
+    session.hooks["response"].append(count_response)
     if session_cookie_key is not None:
         session.cookies[session_cookie_key] = session_id
 
@@ -60,6 +62,7 @@ def fetch_players() -> List[PlayerPrototype]:
                            "Make sure that the account credentials specified in the settings file is valid.")
 
     # Now, if we reach this piece of code, we are definitely logged in.
+    FETCH_RELOGINS.inc()
     # We can faithfully return the player list returned by the server.
     return list(_try_fetch_players(session))
 
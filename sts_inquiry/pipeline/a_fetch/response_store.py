@@ -0,0 +1,47 @@
+import hashlib
+import os
+import pickle
+import threading
+from dataclasses import dataclass
+from typing import Optional
+
+
+@dataclass(frozen=True)
+class StoredResponse:
+    url: str
+    etag: Optional[str]
+    last_modified: Optional[str]
+    content_hash: str
+    content: bytes
+
+
+class ResponseStore:
+    # Persists the last successful response for each URL on disk so that later fetches can be conditional.
+    # Every URL gets its own file, which is replaced atomically, so concurrent fetch threads can safely share a store.
+
+    def __init__(self, directory: str):
+        self._directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def load(self, url: str) -> Optional[StoredResponse]:
+        try:
+            with open(self._path(url), "rb") as f:
+                stored = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+        # Guard against hash collisions of the file names.
+        return stored if stored.url == url else None
+
+    def save(self, stored: StoredResponse):
+        path = self._path(stored.url)
+        tmp_path = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(stored, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    def _path(self, url: str) -> str:
+        return os.path.join(self._directory, hashlib.sha1(url.encode()).hexdigest())
+
+
+def content_hash(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
@@ -1,11 +1,13 @@
 import logging
-from typing import Collection, List
+from typing import Collection, List, Set, Dict, Tuple
+
+import numpy as np
 
 from sts_inquiry.consts import INSTANCES
 from sts_inquiry.pipeline.a_fetch.landscape_fetcher import SuperRegionPrototype, RegionPrototype, EdgePrototype, \
     StwPrototype
 from sts_inquiry.pipeline.a_fetch.player_fetcher import PlayerPrototype
-from sts_inquiry.structs import World, Edge, SuperRegion, Region, Stw, Neighbor, Player
+from sts_inquiry.structs import World, Graph, Edge, SuperRegion, Region, Stw, Neighbor, Player
 
 log = logging.getLogger("sts-inquiry")
 
@@ -35,7 +37,6 @@ def link_landscape(superregion_protos: Collection[SuperRegionPrototype], region_
     # Players are also ignored since that information will be linked into the world later on.
     stws = {proto.aid: Stw(aid=proto.aid,
                            region=regions[proto.rid],
-                           occupants=[],
                            neighbors=[],
                            name=proto.name,
                            description=proto.description,
@@ -62,17 +63,75 @@ def link_landscape(superregion_protos: Collection[SuperRegionPrototype], region_
     log.info(" * Finished linking landscape.")
 
     # Create the world.
+    stws = list(stws.values())
     return World(superregions=list(superregions.values()),
                  regions=list(regions.values()),
-                 stws=list(stws.values()),
-                 edges=edges)
+                 stws=stws,
+                 edges=edges,
+                 graph=_build_graph(stws, edges))
+
+
+def _build_graph(stws: List[Stw], edges: List[Edge]) -> Graph:
+    stw_indices = {stw.aid: idx for idx, stw in enumerate(stws)}
+
+    # Collapse duplicate edges; a pair of stws has a handover if any of its edges has one.
+    pair_handovers: Dict[Tuple[int, int], bool] = {}
+    for edge in edges:
+        idx_1, idx_2 = (stw_indices[stw.aid] for stw in edge.stws)
+        for pair in ((idx_1, idx_2), (idx_2, idx_1)):
+            pair_handovers[pair] = pair_handovers.get(pair, False) or edge.handover
+    pairs = sorted(pair_handovers)
+
+    indptr = np.zeros(len(stws) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(np.array([idx for idx, _ in pairs], dtype=np.int64), minlength=len(stws)), out=indptr[1:])
+
+    def float_or_nan(val):
+        return np.nan if val is None else val
+
+    return Graph(indptr=indptr,
+                 indices=np.array([nghbr_idx for _, nghbr_idx in pairs], dtype=np.int32),
+                 handover=np.array([pair_handovers[pair] for pair in pairs], dtype=bool),
+                 aids=np.array([stw.aid for stw in stws], dtype=np.int64),
+                 rids=np.array([stw.region.rid for stw in stws], dtype=np.int64),
+                 urids=np.array([stw.region.superregion.urid for stw in stws], dtype=np.int64),
+                 difficulty=np.array([float_or_nan(stw.difficulty) for stw in stws], dtype=np.float64),
+                 entertainment=np.array([float_or_nan(stw.entertainment) for stw in stws], dtype=np.float64))
+
+
+def link_players(world: World, player_items: List[PlayerPrototype]) -> Dict[Tuple[int, int], Player]:
+    # Returns the occupant of each occupied stw, by (aid, instance).
+    # The world itself is not touched, since it is shared with searches that are still running.
+    aids = {stw.aid for stw in world.stws}
+    return {(pl_i.aid, pl_i.instance): Player(name=pl_i.name,
+                                              stitz=pl_i.stitz,
+                                              start_time=pl_i.start_time)
+            for pl_i in player_items if pl_i.aid in aids}
+
+
+def occupancy(world: World, player_items: List[PlayerPrototype]) -> np.ndarray:
+    # Row i tells which stws (by their index in World.stws) are occupied in INSTANCES[i].
+    return np.stack([np.isin(world.graph.aids, [pl_i.aid for pl_i in player_items if pl_i.instance == inst])
+                     for inst in INSTANCES])
+
+
+def diff_landscape(old_world: World, new_world: World) -> Set[int]:
+    # Returns the aids of all stws whose clusters might have different landscape metrics in the new world:
+    # stws that have been added or removed, whose relevant properties have changed,
+    # or which are an endpoint of an edge that has been added, removed, or changed.
+    old_stws = {stw.aid: stw for stw in old_world.stws}
+    new_stws = {stw.aid: stw for stw in new_world.stws}
+
+    changed_aids = set(old_stws.keys() ^ new_stws.keys())
+    changed_aids.update(aid for aid in old_stws.keys() & new_stws.keys()
+                        if _stw_key(old_stws[aid]) != _stw_key(new_stws[aid]))
+
+    old_edges = {(frozenset(stw.aid for stw in edge.stws), edge.handover) for edge in old_world.edges}
+    new_edges = {(frozenset(stw.aid for stw in edge.stws), edge.handover) for edge in new_world.edges}
+    for aids, _ in old_edges ^ new_edges:
+        changed_aids.update(aids)
 
+    return changed_aids
 
-def link_players(world: World, player_items: List[PlayerPrototype]):
-    player_lookup = {(pl_i.aid, pl_i.instance): Player(name=pl_i.name,
-                                                       stitz=pl_i.stitz,
-                                                       start_time=pl_i.start_time)
-                     for pl_i in player_items}
 
-    for stw in world.stws:
-        stw.occupants = [player_lookup.get((stw.aid, inst)) for inst in INSTANCES]
+def _stw_key(stw: Stw):
+    return stw.name, stw.difficulty, stw.entertainment, stw.region.rid, stw.region.superregion.urid
@@ -1,36 +1,95 @@
 import logging
-from typing import List, Set, FrozenSet
+from functools import partial
+from typing import List, Set, Sequence, Optional, Collection
+
+import numpy as np
 
 from sts_inquiry import app
-from sts_inquiry.structs import World, Stw
+from sts_inquiry.pipeline.parallel import parallel_map, n_workers
+from sts_inquiry.structs import World, Graph
 
 _MAX_CLUSTER_SIZE = app.config["MAX_CLUSTER_SIZE"]
+# The number of clusters grown from each root varies a lot, so hand out more shards than there are workers.
+# Smaller shards, e.g., when only a few stws have changed, are not worth starting the workers for.
+_SHARDS_PER_WORKER = 4
+_MIN_ROOTS_PER_SHARD = 64
 
 log = logging.getLogger("sts-inquiry")
 
 
-def cluster_landscape(world: World) -> List[Set[FrozenSet[Stw]]]:
-    log.info(" * Computing stw clusters up to size %d...", _MAX_CLUSTER_SIZE)
+def cluster_landscape(world: World, max_size: int = _MAX_CLUSTER_SIZE) -> List[np.ndarray]:
+    log.info(" * Computing stw clusters up to size %d...", max_size)
 
-    # We get these first two clusters for free.
-    one_clusters = {frozenset({stw}) for stw in world.stws}
-    two_clusters = {frozenset(edge.stws) for edge in world.edges}
+    all_clusters = _enumerate_sharded(world.graph, max_size)
 
-    all_clusters = [one_clusters, two_clusters]
+    log.info(" * Finished computing a total of %d stw clusters.", sum(len(clusters) for clusters in all_clusters))
 
-    for _ in range(_MAX_CLUSTER_SIZE - 2):
-        prev_clusters = all_clusters[-1]
+    return all_clusters
 
-        cur_clusters = set()
-        all_clusters.append(cur_clusters)
 
-        for cluster in prev_clusters:
-            nghbr_stws = {nghbr.stw
-                          for stw in cluster for nghbr in stw.neighbors
-                          if nghbr.stw not in cluster}
-            for nghbr_stw in nghbr_stws:
-                cur_clusters.add(cluster.union({nghbr_stw}))
+def cluster_around(world: World, aids: Collection[int], max_size: int = _MAX_CLUSTER_SIZE) -> List[np.ndarray]:
+    # Computes only the clusters that contain at least one of the stws with the given aids.
+    log.info(" * Computing the stw clusters up to size %d around %d stws...", max_size, len(aids))
+    roots = np.flatnonzero(np.isin(world.graph.aids, list(aids))).tolist()
+    return _enumerate_sharded(world.graph, max_size, roots)
 
-    log.info(" * Finished computing a total of %d stw clusters.", sum(len(clusters) for clusters in all_clusters))
 
-    return all_clusters
+def _enumerate_sharded(graph: Graph, max_size: int, roots: Optional[Sequence[int]] = None) -> List[np.ndarray]:
+    # The clusters grown from different roots are disjoint, so the roots are dealt out to the workers round-robin.
+    # The order of the clusters doesn't matter since the dfs are ordered by their aids anyway.
+    all_roots = range(len(graph.aids)) if roots is None else roots
+    n_shards = max(1, min(n_workers() * _SHARDS_PER_WORKER, len(all_roots) // _MIN_ROOTS_PER_SHARD))
+    if n_shards == 1:
+        return enumerate_clusters(adjacency(graph), max_size, roots)
+    shards = [list(all_roots[pos::n_shards]) for pos in range(n_shards)]
+    parts = parallel_map(partial(_enumerate_shard, graph, max_size, roots), shards)
+    return [np.concatenate([part[size - 1] for part in parts]) for size in range(1, max_size + 1)]
+
+
+def _enumerate_shard(graph: Graph, max_size: int, roots: Optional[Sequence[int]], shard: Sequence[int]) \
+        -> List[np.ndarray]:
+    return enumerate_clusters(adjacency(graph), max_size, roots, shard)
+
+
+def adjacency(graph: Graph) -> List[List[int]]:
+    indptr, indices = graph.indptr.tolist(), graph.indices.tolist()
+    return [indices[start:end] for start, end in zip(indptr[:-1], indptr[1:])]
+
+
+def enumerate_clusters(adj: Sequence[Sequence[int]], max_size: int,
+                       roots: Optional[Sequence[int]] = None, shard: Optional[Sequence[int]] = None) \
+        -> List[np.ndarray]:
+    # Enumerates every connected subgraph with up to max_size nodes exactly once using the ESU algorithm
+    # (Wernicke, 2006): each subgraph is only grown from its smallest node, and only by nodes that are larger than
+    # that root and either already are extension candidates or are exclusive neighbors of the newly added node,
+    # i.e., not adjacent to any node already in the subgraph. Hence, no subgraph is ever produced twice and no
+    # deduplication is needed.
+    # If roots are given, only the subgraphs that contain at least one of them are enumerated. For that, the roots
+    # are ranked smaller than all other nodes, so that each such subgraph is only grown from its smallest root.
+    # If a shard of the roots is given, only the subgraphs grown from the roots in it are enumerated.
+    # Returns one matrix per cluster size k whose rows are the sorted node indices of each cluster of size k.
+    if roots is None:
+        roots = range(len(adj))
+        rank = roots
+    else:
+        rank = [len(roots) + node for node in range(len(adj))]
+        for root_rank, root in enumerate(roots):
+            rank[root] = root_rank
+
+    all_clusters: List[list] = [[] for _ in range(max_size)]
+
+    def extend(sub: tuple, sub_nbhd: Set[int], ext: List[int], root: int):
+        all_clusters[len(sub) - 1].append(sub)
+        if len(sub) == max_size:
+            return
+        ext = ext[:]
+        while ext:
+            node = ext.pop()
+            excl_nghbrs = [nghbr for nghbr in adj[node] if rank[nghbr] > rank[root] and nghbr not in sub_nbhd]
+            extend(sub + (node,), sub_nbhd.union(adj[node]), ext + excl_nghbrs, root)
+
+    for root in roots if shard is None else shard:
+        extend((root,), {root, *adj[root]}, [nghbr for nghbr in adj[root] if rank[nghbr] > rank[root]], root)
+
+    return [np.sort(np.array(clusters, dtype=np.int32).reshape(len(clusters), size), axis=1)
+            for size, clusters in enumerate(all_clusters, start=1)]
@@ -1,96 +1,319 @@
 import logging
-from statistics import mean, StatisticsError
-from typing import Iterable, Iterator, Collection, List, Set, FrozenSet
+from functools import partial
+from typing import Iterable, Iterator, List, Set, Dict, Tuple, Sequence, Optional
 
+import numpy as np
 import pandas as pd
 
 from sts_inquiry.consts import INSTANCES
-from sts_inquiry.structs import Edge, Stw
+from sts_inquiry.pipeline.parallel import parallel_map
+from sts_inquiry.structs import World, Graph, ClusterIndex, Edge
 
 log = logging.getLogger("sts-inquiry")
 
+# Columns that hold the landscape metrics of each cluster.
+METRIC_COL_NAMES = ["intra_handovers", "nghbr_handovers", "n_neighbors",
+                    "mean_difficulty", "mean_entertainment", "mean_difent",
+                    "min_difficulty", "min_entertainment", "min_difent"]
+# Columns of the occupancy tables computed by player_metrics() that vary per instance.
+PLAYER_COL_NAMES = ["free", "nghbr_occupants", "region_occupants"]
+
+# Bounds the size of the temporary arrays that hold the adjacency of a chunk of clusters.
+_CHUNK_SIZE = 1 << 16
+# The Sts website reports the scores with two decimals, so they are summed exactly as integers in these units.
+_SCORE_UNITS = 10 ** 6
+
+
+def member_col_names(cluster_size: int) -> List[str]:
+    # Each cluster is stored as the sorted indices of its stws in World.stws, one column per member.
+    return [f"member_{pos}" for pos in range(cluster_size)]
 
-def _statistic(stat: callable, vals: Iterable):
-    try:
-        return stat(val for val in vals if val is not None)
-    except (ValueError, TypeError, StatisticsError):
-        return None
 
+def members(df: pd.DataFrame, cluster_size: int) -> np.ndarray:
+    return df[member_col_names(cluster_size)].to_numpy()
 
-def landscape_metrics(all_clusters: Iterable[Set[FrozenSet[Stw]]]) -> Iterator[pd.DataFrame]:
+
+def landscape_metrics(world: World, all_clusters: Iterable[np.ndarray]) -> Iterator[pd.DataFrame]:
     log.info(" * Computing landscape metrics for all clusters...")
 
-    for clusters in all_clusters:
-        clusters = list(clusters)
-
-        col_neighbors = [{nghbr.stw
-                          for stw in cluster for nghbr in stw.neighbors
-                          if nghbr.stw not in cluster}
-                         for cluster in clusters]
-        col_intra_edges = [_intra_or_nghbr_edges("intra", cluster) for cluster in clusters]
-        col_nghbr_edges = [_intra_or_nghbr_edges("nghbr", cluster) for cluster in clusters]
-        col_regions = [{stw.region for stw in cluster} for cluster in clusters]
-
-        col_difents = [[_statistic(mean, [stw.difficulty, stw.entertainment])
-                        for stw in cluster] for cluster in clusters]
-
-        cols = {
-            "cluster": clusters,
-            "neighbors": col_neighbors,
-            "intra_edges": col_intra_edges,
-            "regions": col_regions,
-
-            # Metrics
-            "intra_handovers": [sum(edge.handover for edge in edges) for edges in col_intra_edges],
-            "nghbr_handovers": [sum(edge.handover for edge in edges) for edges in col_nghbr_edges],
-            "n_neighbors": [len(nghbrs) for nghbrs in col_neighbors],
-            "mean_difficulty": [_statistic(mean, (stw.difficulty for stw in cluster)) for cluster in clusters],
-            "mean_entertainment": [_statistic(mean, (stw.entertainment for stw in cluster)) for cluster in clusters],
-            "mean_difent": [_statistic(mean, difents) for difents in col_difents],
-            "min_difficulty": [_statistic(min, (stw.difficulty for stw in cluster)) for cluster in clusters],
-            "min_entertainment": [_statistic(min, (stw.entertainment for stw in cluster)) for cluster in clusters],
-            "min_difent": [_statistic(min, difents) for difents in col_difents],
-
-            # Only used for sorting and filtering
-            "cid": range(len(clusters)),
-            "aids": [{stw.aid for stw in cluster} for cluster in clusters],
-            "urids": [{region.superregion.urid for region in regions} for regions in col_regions],
-            "rids": [{region.rid for region in regions} for regions in col_regions],
-            "concat_names": ["+++".join(stw.name for stw in cluster) for cluster in clusters]
-        }
-
-        df = pd.DataFrame(cols)
-
-        # Necessary for player metrics
-        df = pd.concat((df.assign(instance=inst) for inst in INSTANCES), ignore_index=True)
-
-        yield df
+    for cluster_size, df in enumerate(_all_cluster_metrics(world.graph, all_clusters), start=1):
+        yield _finalize(world, df, cluster_size)
 
     log.info(" * Finished computing landscape metrics.")
 
 
-def _intra_or_nghbr_edges(intra_or_nghbr: str, cluster: FrozenSet[Stw]) -> Set[Edge]:
-    intra_or_nghbr = intra_or_nghbr == "intra"
-    return {Edge(frozenset({stw, nghbr.stw}), nghbr.handover)
-            for stw in cluster for nghbr in stw.neighbors
-            if (nghbr.stw in cluster) == intra_or_nghbr}
+def patch_landscape_metrics(world: World, prev_world: World, prev_dfs: Iterable[Optional[pd.DataFrame]],
+                            changed_aids: Set[int], all_changed_clusters: Iterable[np.ndarray]) \
+        -> Iterator[Optional[pd.DataFrame]]:
+    # Yields the same dfs as landscape_metrics() would for all clusters of the world, but only computes the metrics
+    # of the given changed clusters, which must be exactly those that contain at least one of the changed stws.
+    # The metrics of all other clusters are taken over from the previous dfs.
+    # Sizes whose previous df has not been materialized (see lazy_sizes) are yielded as None again; the changed
+    # clusters need not be given for them.
+    log.info(" * Patching landscape metrics of the clusters that contain changed stws...")
+
+    # The kept clusters only consist of unchanged stws, which all still exist in the new world,
+    # but their stw indices need to be translated to the new world.
+    new_indices = {aid: idx for idx, aid in enumerate(world.graph.aids.tolist())}
+    prev_to_new = np.array([new_indices.get(aid, -1) for aid in prev_world.graph.aids.tolist()], dtype=np.int64)
+    prev_changed = np.isin(prev_world.graph.aids, list(changed_aids))
+
+    prev_dfs = list(prev_dfs)
+    all_changed_metrics = iter(_all_cluster_metrics(world.graph, [
+        changed_clusters for prev_df, changed_clusters in zip(prev_dfs, all_changed_clusters) if prev_df is not None]))
+    for cluster_size, prev_df in enumerate(prev_dfs, start=1):
+        if prev_df is None:
+            yield None
+            continue
+        changed_metrics = next(all_changed_metrics)
+        prev_clusters = members(prev_df, cluster_size)
+        kept = ~prev_changed[prev_clusters].any(axis=1)
+
+        kept_df = pd.DataFrame({
+            **_member_cols(np.sort(prev_to_new[prev_clusters[kept]], axis=1)),
+            **{col_name: prev_df[col_name].to_numpy()[kept] for col_name in METRIC_COL_NAMES}
+        })
+
+        df = pd.concat((kept_df, changed_metrics), ignore_index=True)
+        yield _finalize(world, df, cluster_size)
+
+    log.info(" * Finished patching landscape metrics.")
+
+
+def cluster_size_metrics(world: World, clusters: np.ndarray, cluster_size: int) -> pd.DataFrame:
+    # Computes the df of a single cluster size, given all of its clusters.
+    return _finalize(world, _cluster_metrics(world.graph, clusters), cluster_size)
+
+
+def _member_cols(clusters: np.ndarray) -> Dict[str, np.ndarray]:
+    clusters = clusters.astype(np.int32, copy=False)
+    return {col_name: clusters[:, pos] for pos, col_name in enumerate(member_col_names(clusters.shape[1]))}
+
+
+def _all_cluster_metrics(graph: Graph, all_clusters: Iterable[np.ndarray]) -> List[pd.DataFrame]:
+    # The metrics of each cluster only depend on the graph and the cluster itself. The largest size has by far the most
+    # clusters, so the clusters of all sizes are split into chunks of rows, which are dealt out to the workers and then
+    # joined again per size. Only the compact arrays are sent to the workers.
+    all_clusters = list(all_clusters)
+    if sum(len(clusters) for clusters in all_clusters) < _CHUNK_SIZE:
+        # Starting the workers would take longer.
+        return [_cluster_metrics(graph, clusters) for clusters in all_clusters]
+    # Each size gets at least one (possibly empty) chunk so that it has a df with the right columns.
+    sizes, chunks = zip(*[(pos, clusters[start:start + _CHUNK_SIZE])
+                          for pos, clusters in enumerate(all_clusters)
+                          for start in range(0, max(len(clusters), 1), _CHUNK_SIZE)])
+    parts = parallel_map(partial(_cluster_metrics, graph), chunks)
+    return [pd.concat([part for part_pos, part in zip(sizes, parts) if part_pos == pos], ignore_index=True)
+            for pos in range(len(all_clusters))]
+
+
+def _cluster_metrics(graph: Graph, clusters: np.ndarray) -> pd.DataFrame:
+    difents = _difents(graph.difficulty, graph.entertainment)
+
+    col_intra_handovers, col_nghbr_handovers, col_n_neighbors = [], [], []
+    for start in range(0, len(clusters), _CHUNK_SIZE):
+        chunk = clusters[start:start + _CHUNK_SIZE]
+        rows, nghbrs, handovers = cluster_adjacency(graph, chunk)
+        intra = (chunk[rows] == nghbrs[:, None]).any(axis=1)
+        # Each intra edge is seen from both of its ends.
+        col_intra_handovers.append(np.bincount(rows[intra & handovers], minlength=len(chunk)) // 2)
+        col_nghbr_handovers.append(np.bincount(rows[~intra & handovers], minlength=len(chunk)))
+        # A neighbor that is adjacent to multiple stws of the cluster must only be counted once.
+        nghbr_keys = np.unique(rows[~intra] * len(graph.aids) + nghbrs[~intra])
+        col_n_neighbors.append(np.bincount(nghbr_keys // len(graph.aids), minlength=len(chunk)))
+
+    def int_col(parts):
+        return np.concatenate(parts) if parts else np.zeros(0, dtype=np.int64)
+
+    mean_difficulty, min_difficulty = _mean_and_min(graph.difficulty[clusters])
+    mean_entertainment, min_entertainment = _mean_and_min(graph.entertainment[clusters])
+    mean_difent, min_difent = _mean_and_min(difents[clusters])
+
+    return pd.DataFrame({
+        **_member_cols(clusters),
+
+        # Metrics
+        "intra_handovers": int_col(col_intra_handovers),
+        "nghbr_handovers": int_col(col_nghbr_handovers),
+        "n_neighbors": int_col(col_n_neighbors),
+        "mean_difficulty": mean_difficulty,
+        "mean_entertainment": mean_entertainment,
+        "mean_difent": mean_difent,
+        "min_difficulty": min_difficulty,
+        "min_entertainment": min_entertainment,
+        "min_difent": min_difent
+    })
+
+
+def cluster_adjacency(graph: Graph, clusters: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Flattens the adjacency lists of all stws of the given clusters into three parallel arrays, which hold
+    # the row of the cluster, the neighbor's stw index, and whether there is a handover to that neighbor.
+    # Neighbors inside the cluster are included as well.
+    flat = clusters.ravel()
+    starts = graph.indptr[flat]
+    degrees = graph.indptr[flat + 1] - starts
+    entries = np.repeat(starts - (np.cumsum(degrees) - degrees), degrees) + np.arange(degrees.sum())
+    rows = np.repeat(np.arange(len(clusters), dtype=np.int64), clusters.shape[1])
+    return np.repeat(rows, degrees), graph.indices[entries], graph.handover[entries]
+
+
+def _difents(difficulty: np.ndarray, entertainment: np.ndarray) -> np.ndarray:
+    # The mean of each stw's difficulty and entertainment, ignoring whichever is unknown.
+    both = (_score_units(difficulty) + _score_units(entertainment)) / (2 * _SCORE_UNITS)
+    return np.where(np.isnan(difficulty), entertainment, np.where(np.isnan(entertainment), difficulty, both))
+
+
+def _mean_and_min(vals: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # Computes the mean and minimum of each row, ignoring NaNs. If a row only holds NaNs, so are its statistics.
+    # Like statistics.mean(), the mean is only rounded once, after the exact sum has been divided. So clusters whose
+    # scores have the same mean always tie exactly, even if they are made of different scores.
+    known = ~np.isnan(vals)
+    with np.errstate(invalid="ignore"):
+        means = _score_units(vals).sum(axis=1) / (known.sum(axis=1) * _SCORE_UNITS)
+    return means, np.fmin.reduce(vals, axis=1)
+
+
+def _score_units(vals: np.ndarray) -> np.ndarray:
+    # The scores as integer multiples of 1 / _SCORE_UNITS, with unknown scores as 0.
+    return np.rint(np.where(np.isnan(vals), 0, vals) * _SCORE_UNITS).astype(np.int64)
+
+
+def _finalize(world: World, df: pd.DataFrame, cluster_size: int) -> pd.DataFrame:
+    # Order the clusters by their aids so that equal landscapes always yield equal dfs, no matter how they were built.
+    clusters = members(df, cluster_size)
+    order = np.lexsort(np.sort(world.graph.aids[clusters], axis=1).T[::-1])
+    df = df.iloc[order].reset_index(drop=True)
+
+    if cluster_size == 1:
+        # Single stws are also sorted by their names. Equal names get equal ranks, so sorting by the rank is the same
+        # as sorting by the name, but the column is numeric and can be shared via snapshots like all others.
+        df = df.assign(name_rank=_name_ranks(world)[clusters[order][:, 0]])
+
+    # Only used for sorting and filtering
+    return df.assign(cid=range(len(df)))
+
+
+def _name_ranks(world: World) -> np.ndarray:
+    # The position of each stw's name in the sorted list of all distinct names.
+    return np.unique(np.array([stw.name for stw in world.stws], dtype=str), return_inverse=True)[1].astype(np.int32)
+
+
+def cluster_index(world: World, df: pd.DataFrame, cluster_size: int) -> ClusterIndex:
+    # Filtering by stws, e.g., by their regions or names, only needs to look up the clusters of the matching stws
+    # in this index instead of looking at every cluster.
+    flat = members(df, cluster_size).ravel()
+    order = np.argsort(flat, kind="stable")
+    indptr = np.zeros(len(world.stws) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(flat, minlength=len(world.stws)), out=indptr[1:])
+    cids = np.repeat(df["cid"].to_numpy(dtype=np.int32), cluster_size)[order]
+
+    # Searches that sort by a single column then only need to skip the clusters that have been filtered out.
+    sort_keys = [(col_name, ascending) for col_name in METRIC_COL_NAMES for ascending in (True, False)]
+    if cluster_size == 1:
+        sort_keys.append(("name_rank", True))
+    sorted_cids = {(col_name, ascending): df.sort_values(col_name, ascending=ascending, kind="mergesort")["cid"]
+                   .to_numpy(dtype=np.int32)
+                   for col_name, ascending in sort_keys}
+
+    # Filtering by regions only needs to look at the shards of the selected regions.
+    region_pos = {region.rid: pos for pos, region in enumerate(world.regions)}
+    stw_region_pos = np.array([region_pos[stw.region.rid] for stw in world.stws], dtype=np.int64)
+    keys = np.unique(stw_region_pos[members(df, cluster_size)] * len(df) + df["cid"].to_numpy()[:, None])
+    region_indptr = np.zeros(len(world.regions) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(keys // max(len(df), 1), minlength=len(world.regions)), out=region_indptr[1:])
+    region_cids = (keys % max(len(df), 1)).astype(np.int32)
+
+    return ClusterIndex(indptr=indptr, cids=cids, n_clusters=len(df), sorted_cids=sorted_cids,
+                        region_indptr=region_indptr, region_cids=region_cids)
+
+
+def find_cluster(world: World, df: pd.DataFrame, cluster_size: int, aids: Set[int]) -> Optional[int]:
+    # Returns the cid of the cluster that consists of exactly the given stws, if there is one. The clusters are
+    # ordered by their sorted aids (see _finalize()), so these are the key of a binary search over the rows.
+    if len(aids) != cluster_size:
+        return None
+    key = sorted(aids)
+    member_cols = [df[col_name].to_numpy() for col_name in member_col_names(cluster_size)]
+
+    def cluster_key(cid: int) -> List[int]:
+        return sorted(world.graph.aids[[member_col[cid] for member_col in member_cols]].tolist())
+
+    lo, hi = 0, len(df)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if cluster_key(mid) < key:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo if lo < len(df) and cluster_key(lo) == key else None
+
+
+def cluster_objects(world: World, clusters: np.ndarray) -> Dict[str, list]:
+    # Materializes the world objects that are needed to render the given clusters.
+    graph = world.graph
+    cols = {"cluster": [], "neighbors": [], "intra_edges": [], "regions": [], "aids": []}
+    for cluster in clusters.tolist():
+        cluster_set = set(cluster)
+        stws = [world.stws[idx] for idx in cluster]
+        nghbr_idxs = sorted({nghbr_idx for idx in cluster for nghbr_idx in graph.neighbors(idx).tolist()
+                             if nghbr_idx not in cluster_set})
+
+        cols["cluster"].append(stws)
+        cols["neighbors"].append([world.stws[nghbr_idx] for nghbr_idx in nghbr_idxs])
+        cols["intra_edges"].append([
+            Edge(frozenset({world.stws[idx], world.stws[nghbr_idx]}), handover)
+            for idx in cluster
+            for nghbr_idx, handover in zip(graph.neighbors(idx).tolist(), graph.neighbor_handovers(idx).tolist())
+            if nghbr_idx in cluster_set and idx < nghbr_idx
+        ])
+        cols["regions"].append(list(dict.fromkeys(stw.region for stw in stws)))
+        cols["aids"].append(sorted(stw.aid for stw in stws))
+    return cols
 
 
-def player_metrics(dfs: List[pd.DataFrame]):
-    for idx in range(len(dfs)):
-        df = dfs[idx]
+def player_metrics(world: World, dfs: Sequence[Optional[pd.DataFrame]], occupied: np.ndarray) \
+        -> List[Optional[pd.DataFrame]]:
+    # Returns one occupancy table per df with one row per cluster and instance, given the occupancy matrix
+    # (see occupancy()). The rows are ordered by instance and then by cid, so the row of cid c in INSTANCES[i] is
+    # i * len(df) + c. The dfs themselves do not depend on the players and are left untouched.
+    graph = world.graph
+    region_idxs = np.unique(graph.rids, return_inverse=True)[1]
+    # How many stws of each stw's region are occupied, per instance.
+    stw_region_occupants = np.stack([np.bincount(region_idxs[occ], minlength=region_idxs.max(initial=-1) + 1)
+                                     for occ in occupied])[:, region_idxs]
 
-        cols = {
-            "free": [_n_occupied(cluster, inst) == 0 for inst, cluster in zip(df["instance"], df["cluster"])],
-            "nghbr_occupants": [_n_occupied(nghbrs, inst) for inst, nghbrs in zip(df["instance"], df["neighbors"])],
-            "region_occupants": [
-                _statistic(max, (
-                    _n_occupied(region.stws, inst) for region in regions
-                )) for inst, cluster, regions in zip(df["instance"], df["cluster"], df["regions"])]
-        }
+    occupancy_tables = []
+    for cluster_size, df in enumerate(dfs, start=1):
+        # Sizes that have not been materialized have no occupancy table either.
+        if df is None:
+            occupancy_tables.append(None)
+            continue
+        clusters = members(df, cluster_size)
+        occupancy_tables.append(pd.DataFrame({
+            "cid": np.tile(df["cid"].to_numpy(), len(INSTANCES)),
+            "instance": np.repeat(INSTANCES, len(df)),
+            "free": np.concatenate([~occ[clusters].any(axis=1) for occ in occupied]),
+            "nghbr_occupants": np.concatenate([_nghbr_occupants(graph, clusters, occ) for occ in occupied]),
+            "region_occupants": np.concatenate([stw_occ[clusters].max(axis=1) for stw_occ in stw_region_occupants])
+        }))
+    return occupancy_tables
 
-        dfs[idx] = df.assign(**cols)
 
+def _nghbr_occupants(graph: Graph, clusters: np.ndarray, occupied: np.ndarray) -> np.ndarray:
+    # Only clusters with a stw that is adjacent to an occupied stw can have occupied neighbors,
+    # so only look at the adjacency of those.
+    occupied_entries = occupied[graph.indices]
+    nghbr_of_occupied = np.zeros(len(occupied), dtype=bool)
+    nghbr_of_occupied[np.repeat(np.arange(len(occupied)), np.diff(graph.indptr))[occupied_entries]] = True
+    candidates = np.flatnonzero(nghbr_of_occupied[clusters].any(axis=1))
 
-def _n_occupied(stws: Collection[Stw], inst: int) -> int:
-    return sum(stw.occupant_at(inst) is not None for stw in stws)
+    counts = np.zeros(len(clusters), dtype=np.int64)
+    for start in range(0, len(candidates), _CHUNK_SIZE):
+        chunk_rows = candidates[start:start + _CHUNK_SIZE]
+        chunk = clusters[chunk_rows]
+        rows, nghbrs, _ = cluster_adjacency(graph, chunk)
+        outer_occupied = occupied[nghbrs] & ~(chunk[rows] == nghbrs[:, None]).any(axis=1)
+        # A neighbor that is adjacent to multiple stws of the cluster must only be counted once.
+        nghbr_keys = np.unique(rows[outer_occupied] * len(occupied) + nghbrs[outer_occupied])
+        counts[chunk_rows] = np.bincount(nghbr_keys // len(occupied), minlength=len(chunk))
+    return counts
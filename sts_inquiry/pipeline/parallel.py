@@ -0,0 +1,35 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Sequence, TypeVar, List
+
+from sts_inquiry import app
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+_WORKERS = app.config["PIPELINE_WORKERS"] or os.cpu_count() or 1
+
+# Forking this process directly is unsafe because other threads (e.g., the cache updater's) might hold locks at that
+# moment, so the workers are forked from a fork server, which is a fresh single-threaded process. The workers import
+# sts_inquiry when they unpickle fn, which neither starts a cache updater nor configures logging in them (see
+# sts_inquiry/__init__). The fork server preloads the heavy libraries so that starting the workers stays cheap.
+if "forkserver" in multiprocessing.get_all_start_methods():
+    _MP_CONTEXT = multiprocessing.get_context("forkserver")
+    _MP_CONTEXT.set_forkserver_preload(["numpy", "pandas"])
+else:
+    _MP_CONTEXT = multiprocessing.get_context("spawn")
+
+
+def n_workers() -> int:
+    return _WORKERS
+
+
+def parallel_map(fn: Callable[[T], R], items: Sequence[T]) -> List[R]:
+    # Applies fn to all items in a pool of worker processes and returns the results in the order of the items.
+    # Both fn and the items are pickled, so they should be top-level functions and compact arrays, not world objects.
+    if _WORKERS == 1 or len(items) <= 1:
+        return [fn(item) for item in items]
+
+    with ProcessPoolExecutor(max_workers=min(_WORKERS, len(items)), mp_context=_MP_CONTEXT) as executor:
+        return list(executor.map(fn, items))
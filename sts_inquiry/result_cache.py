@@ -0,0 +1,65 @@
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from threading import Lock
+from typing import Hashable, Optional, Any, Dict, Tuple, Callable
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+
+class ResultCache:
+    # A thread-safe LRU cache whose entries also expire after a while. Its size is bounded by the sum of the sizes
+    # that are given for the entries, e.g., their number of bytes. A max size of 0 disables the cache.
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.stats = CacheStats()
+        self._lock = Lock()
+        # By key: (expiry time, size, value), from least to most recently used.
+        self._entries: OrderedDict[Hashable, Tuple[float, int, Any]] = OrderedDict()
+        self._size = 0
+
+    def get(self, key: Hashable, usable: Optional[Callable[[Any], bool]] = None) -> Optional[Any]:
+        # Cached values that are not usable for the caller count as misses.
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is None or (usable is not None and not usable(entry[2])):
+                self.stats.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats.hits += 1
+            return entry[2]
+
+    def put(self, key: Hashable, value: Any, size: int = 1):
+        if size > self.max_size:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            while self._size + size > self.max_size:
+                self._remove(next(iter(self._entries)))
+                self.stats.evictions += 1
+            self._entries[key] = (time.monotonic() + self.ttl, size, value)
+            self._size += size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def info(self) -> Dict[str, int]:
+        with self._lock:
+            return {"hits": self.stats.hits, "misses": self.stats.misses, "evictions": self.stats.evictions,
+                    "entries": len(self._entries), "size": self._size}
+
+    def _remove(self, key: Hashable):
+        self._size -= self._entries.pop(key)[1]
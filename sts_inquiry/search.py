@@ -1,83 +1,197 @@
-from typing import Any, Optional, Tuple, List, Set, Dict
+import re
+from dataclasses import dataclass
+from typing import Optional, Tuple, List, Set, Dict, Any
 
-from sts_inquiry import app, cache
+import numpy as np
+import pandas as pd
+
+from sts_inquiry import app
+from sts_inquiry.cache import State
+from sts_inquiry.consts import INSTANCES
 from sts_inquiry.forms import SearchForm
+from sts_inquiry.instrumentation import SEARCH_SECONDS
+from sts_inquiry.pipeline.d_metrics import METRIC_COL_NAMES, PLAYER_COL_NAMES, members, find_cluster, cluster_objects
+from sts_inquiry.result_cache import ResultCache
+from sts_inquiry.structs import ClusterIndex
 
 _ROWS_PER_PAGE = app.config["ROWS_PER_PAGE"]
 _PER_INST_COL_NAMES = ["instance", "nghbr_occupants", "region_occupants"]
+# Selections of fewer than 1/n of all clusters are sorted on their own instead of through the presorted index.
+_PRESORTED_MIN_SHARE = 16
+
+
+@dataclass(frozen=True)
+class Ranking:
+    # The cids of the clusters that match a search in the order of its sort cols, possibly only the first of them.
+    cids: np.ndarray
+    n_total_rows: int
 
+    def covers(self, n_needed: Optional[int]) -> bool:
+        return len(self.cids) == self.n_total_rows or (n_needed is not None and len(self.cids) >= n_needed)
 
-def search(form: SearchForm, page: int, highlight_cluster_aids: Optional[Set[int]]):
-    with cache.LOCK:
-        # Get the appropriate df for the selected cluster size.
-        cluster_size = form.clustersize.data
-        df = cache.dfs[cluster_size - 1]
 
-        # Filter and sort the df according to the user inputs.
-        df = _filter(df, form)
-        df, sort_cols = _sort(df, cluster_size, form)
+# Rankings by the state version and the canonical search params. The size of each ranking is its number of bytes.
+_results = ResultCache(app.config["SEARCH_CACHE_SIZE"] << 20, app.config["SEARCH_CACHE_TTL"])
 
-        # For now, just remove the duplicates created by each cluster having multiple rows, one for each instance.
-        # Note that we keep the first one, i.e., the winner of the sorting.
-        df_out = df.drop_duplicates("cid")
 
-        # Add a meaningful rank number (= index).
-        df_out = df_out.reset_index()
+def search(state: State, form: SearchForm, page: int, highlight_cluster_aids: Optional[Set[int]],
+           params_key: Optional[tuple] = None):
+    # Get the appropriate dfs for the selected cluster size.
+    # Note that the cid of each cluster is also its row position in its df.
+    cluster_size = form.clustersize.data
+    all_df = state.dfs[cluster_size - 1]
 
-        n_total_rows = df_out.shape[0]
+    highlight_cid = find_cluster(state.world, all_df, cluster_size, highlight_cluster_aids) \
+        if highlight_cluster_aids else None
 
-        # If the user wants to view a specific cluster, find that cluster and go to the page its on.
-        highlight_row_idx = None
-        if highlight_cluster_aids:
-            try:
-                highlight_row_idx = df_out.index[df_out["aids"] == highlight_cluster_aids][0]
-                page = highlight_row_idx // _ROWS_PER_PAGE + 1
-            except IndexError:
-                # In this case, highlight row idx will remain None.
-                pass
+    # Unless we have to find the highlighted cluster, only the clusters up to the current page are needed.
+    ranking = rank(state, form, None if highlight_cid is not None else page * _ROWS_PER_PAGE, params_key)
+    ranked_cids = ranking.cids
 
-        # Limit the amount of results to the current page.
-        start_row = (page - 1) * _ROWS_PER_PAGE
-        df_out = df_out.iloc[start_row:start_row + _ROWS_PER_PAGE]
+    # If the user wants to view a specific cluster, find that cluster and go to the page its on.
+    highlight_row_idx = None
+    if highlight_cid is not None:
+        ranks = np.flatnonzero(ranked_cids == highlight_cid)
+        if len(ranks) != 0:
+            highlight_row_idx = ranks[0]
+            page = highlight_row_idx // _ROWS_PER_PAGE + 1
 
-        # Retroactively merge rows that contain the same cluster for different instances,
-        # if they share the same sorting col values.
-        df_out = _merge_instances(df, df_out, sort_cols)
+    # Limit the amount of results to the current page. The index is the rank of each cluster.
+    start_row = (page - 1) * _ROWS_PER_PAGE
+    page_cids = ranked_cids[start_row:start_row + _ROWS_PER_PAGE]
+    df_out = all_df.iloc[page_cids].set_axis(pd.RangeIndex(start_row, start_row + len(page_cids)))
 
-        # Get the result away from Pandas so that we can release the lock.
+    # Retroactively merge the rows of each cluster for the different instances,
+    # if they share the same sorting col values.
+    with SEARCH_SECONDS.time(phase="merge"):
+        sort_cols, _ = _sort_keys(cluster_size, form)
+        df_out = df_out.assign(**_merge_instances(_page_occupancy(state, form, page_cids), page_cids, sort_cols))
+
+    # Only now materialize the world objects that are needed to render the clusters on the current page.
+    with SEARCH_SECONDS.time(phase="materialize"):
+        df_out = df_out.assign(**cluster_objects(state.world, members(df_out, cluster_size)))
+
+        # Get the result away from Pandas.
         rows = list(df_out.itertuples())
 
-        return cluster_size, page, highlight_row_idx, n_total_rows, rows
+    return cluster_size, page, highlight_row_idx, ranking.n_total_rows, rows
 
 
-def _filter(df, form):
-    if form.instance.used:
-        df = df[df["instance"] == form.instance.data]
+def rank(state: State, form: SearchForm, n_needed: Optional[int], params_key: Optional[tuple] = None) -> Ranking:
+    # Returns the ranking of the clusters that match the search, which covers at least the first n_needed clusters.
+    cluster_size = form.clustersize.data
+    sort_cols, sort_orders = _sort_keys(cluster_size, form)
+    if params_key is None:
+        return _ranking(state, cluster_size, form, sort_cols, sort_orders, n_needed)
 
-    if form.free.used:
-        df = df[df["free"]]
+    # The canonical search params identify the ranking, and the state version changes with every update of
+    # the landscape or the players.
+    key = (state.version, params_key)
+    ranking = _results.get(key, lambda cached: cached.covers(n_needed))
+    if ranking is None:
+        ranking = _ranking(state, cluster_size, form, sort_cols, sort_orders, n_needed)
+        _results.put(key, ranking, ranking.cids.nbytes)
+    return ranking
+
+
+def records(state: State, form: SearchForm, cids: np.ndarray) -> List[Dict[str, Any]]:
+    # Returns plain data about the given clusters of a ranking, which can be serialized as JSON.
+    # The instances of each cluster that match the search are listed from best to worst.
+    cluster_size = form.clustersize.data
+    all_df = state.dfs[cluster_size - 1]
+
+    cols = {"aids": np.sort(state.world.graph.aids[members(all_df, cluster_size)[cids]], axis=1).tolist()}
+    for col_name in METRIC_COL_NAMES:
+        vals = all_df[col_name].to_numpy()[cids]
+        # JSON has no NaN.
+        cols[col_name] = [None if val != val else val for val in vals.tolist()]
+
+    instances: Dict[int, List[Dict[str, Any]]] = {cid: [] for cid in cids.tolist()}
+    for row in _page_occupancy(state, form, cids)[["cid", "instance", *PLAYER_COL_NAMES]].itertuples(index=False):
+        instances[row.cid].append({"instance": int(row.instance), "free": bool(row.free),
+                                   "nghbr_occupants": int(row.nghbr_occupants),
+                                   "region_occupants": int(row.region_occupants)})
+
+    return [{**{col_name: col[idx] for col_name, col in cols.items()}, "instances": instances[cid]}
+            for idx, cid in enumerate(cids.tolist())]
+
+
+def cache_info() -> Dict[str, int]:
+    return _results.info()
+
+
+def _ranking(state: State, cluster_size: int, form, sort_cols: List[str], sort_orders: List[bool],
+             n_needed: Optional[int]) -> Ranking:
+    all_df = state.dfs[cluster_size - 1]
+
+    # Filter the clusters and their rows in the occupancy table according to the user inputs.
+    with SEARCH_SECONDS.time(phase="filter"):
+        cids = _filter(state, cluster_size, form)
+        occ = state.occupancy[cluster_size - 1]
+        if len(cids) < len(all_df):
+            # The rows of the matching clusters in their original order, by instance and then by cid.
+            occ = occ.iloc[(np.arange(len(INSTANCES))[:, None] * len(all_df) + cids).ravel()]
+        occ = _filter_instances(occ, form)
+
+    with SEARCH_SECONDS.time(phase="sort"):
+        if (form.free.used and not form.instance.used) or not set(sort_cols).isdisjoint(PLAYER_COL_NAMES):
+            # The result depends on the instances, so sort the rows of the occupancy table, for which we only need to
+            # gather the sort cols from the cluster df, and rank each cluster by its best row.
+            occ = _sort(_with_sort_cols(occ, all_df, sort_cols), sort_cols, sort_orders)
+            ranked_cids = occ["cid"].drop_duplicates().to_numpy()
+            return Ranking(ranked_cids, len(ranked_cids))
+
+        # All remaining instances of a cluster tie, so just rank the clusters.
+        if form.free.used:
+            cids = np.unique(occ["cid"].to_numpy())
+        return Ranking(_rank(all_df, state.indexes[cluster_size - 1], cids, sort_cols, sort_orders, n_needed),
+                       len(cids))
+
+
+def _filter(state: State, cluster_size: int, form) -> np.ndarray:
+    # Returns the cids of the matching clusters in ascending order. Each name filter first selects the matching stws
+    # and then looks up the clusters that contain them in the index. The region filter only takes the region shards
+    # of the index, so the cost of searching a few regions scales with their size instead of the whole landscape.
+    index = state.indexes[cluster_size - 1]
+    cids = None
+    if form.regions.used and not form.regions.data.all:
+        urids, rids = set(form.regions.data.urids), set(form.regions.data.rids)
+        cids = index.clusters_in_regions(np.array([region.rid in rids or region.superregion.urid in urids
+                                                   for region in state.world.regions], dtype=bool))
 
+    mask = None
     if form.nameincl.used:
-        df = df[df["concat_names"].str.contains(form.nameincl.data, case=False, regex=True)]
+        mask = index.clusters_with_any(_name_mask(state.world, form.nameincl.data))
     if form.nameexcl.used:
-        df = df[~df["concat_names"].str.contains(form.nameexcl.data, case=False, regex=True)]
+        excl_mask = ~index.clusters_with_any(_name_mask(state.world, form.nameexcl.data))
+        mask = excl_mask if mask is None else mask & excl_mask
 
-    if form.regions.used and not form.regions.data.all:
-        filter_urids = set(form.regions.data.urids)
-        filter_rids = set(form.regions.data.rids)
-        if filter_urids and filter_rids:
-            mask = [not filter_urids.isdisjoint(urids) or not filter_rids.isdisjoint(rids)
-                    for urids, rids in zip(df["urids"], df["rids"])]
-        elif filter_urids:
-            mask = [not filter_urids.isdisjoint(urids) for urids in df["urids"]]
-        else:
-            mask = [not filter_rids.isdisjoint(rids) for rids in df["rids"]]
-        df = df[mask]
+    if cids is None:
+        return np.flatnonzero(mask) if mask is not None else np.arange(index.n_clusters)
+    return cids[mask[cids]] if mask is not None else cids
+
+
+def _name_mask(world, pattern: str) -> np.ndarray:
+    regex = re.compile(pattern, re.IGNORECASE)
+    return np.fromiter((regex.search(stw.name) is not None for stw in world.stws), dtype=bool, count=len(world.stws))
+
+
+def _filter_instances(occ, form):
+    if form.instance.used:
+        occ = occ[occ["instance"] == form.instance.data]
+
+    if form.free.used:
+        occ = occ[occ["free"]]
+
+    return occ
 
-    return df
 
+def _with_sort_cols(occ, all_df, sort_cols: List[str]):
+    return occ.assign(**{col_name: all_df[col_name].to_numpy()[occ["cid"].to_numpy()]
+                         for col_name in sort_cols if col_name not in occ})
 
-def _sort(df, cluster_size: int, form):
+
+def _sort_keys(cluster_size: int, form) -> Tuple[List[str], List[bool]]:
     sort_cols, sort_orders = [], []
     for sortby_field in (form.sortby1, form.sortby2, form.sortby3, form.sortby4):
         if sortby_field.used:
@@ -87,34 +201,81 @@ def _sort(df, cluster_size: int, form):
 
     # Also sort the results by name if we're searching for individual stws
     if cluster_size == 1:
-        sort_cols.append("concat_names")
+        sort_cols.append("name_rank")
         sort_orders.append(True)
 
+    return sort_cols, sort_orders
+
+
+def _sort(df, sort_cols: List[str], sort_orders: List[bool]):
     if sort_cols:
         # We use mergesort because that is stable and the instance merging later on
         # requires stability for the instances to be in proper order.
         df = df.sort_values(sort_cols, ascending=sort_orders, kind="mergesort")
+    return df
 
-    return df, sort_cols
 
+def _rank(all_df, index: ClusterIndex, cids: np.ndarray, sort_cols: List[str], sort_orders: List[bool],
+          n_needed: Optional[int]) -> np.ndarray:
+    # Returns the given cids, which must be ascending, in the order of the sort cols,
+    # though possibly only the first n_needed of them.
+    if not sort_cols:
+        return cids
 
-def _merge_instances(df, df_out, sort_cols: List[str]):
-    seen_cids: Dict[int, Tuple[Any, int]] = {}
+    # Going through the presorted cids takes time in the number of all clusters, so a small selection, e.g., that of
+    # a few regions, is faster sorted on its own. As the df is ordered by cid, both ways sort the same.
+    sorted_cids = index.sorted_cids.get((sort_cols[0], sort_orders[0]))
+    if sorted_cids is None or len(cids) * _PRESORTED_MIN_SHARE < index.n_clusters:
+        vals = all_df[sort_cols[0]].to_numpy()[cids]
+        if len(sort_cols) == 1 and vals.dtype.kind in "if":
+            # Negating keeps the NaNs last and the sort stable, just like Pandas does.
+            return cids[np.argsort(vals if sort_orders[0] else -vals, kind="stable")]
+        return _sort(all_df.iloc[cids], sort_cols, sort_orders)["cid"].to_numpy()
+    if len(cids) < index.n_clusters:
+        mask = np.zeros(index.n_clusters, dtype=bool)
+        mask[cids] = True
+        sorted_cids = sorted_cids[mask[sorted_cids]]
+    if len(sort_cols) == 1:
+        return sorted_cids
 
-    new_cols = {col_name: [] for col_name in _PER_INST_COL_NAMES}
-    new_idx_ctr = 0
+    # The first n_needed clusters can only be those that come before the n_needed-th cluster by the first sort col
+    # or tie with it, so only these have to be sorted by all sort cols.
+    if n_needed is not None and n_needed < len(sorted_cids):
+        first_col = all_df[sort_cols[0]].to_numpy()[sorted_cids]
+        last = first_col[n_needed - 1]
+        ties = pd.isna(first_col[n_needed:]) if pd.isna(last) else first_col[n_needed:] == last
+        sorted_cids = sorted_cids[:n_needed + (len(ties) if ties.all() else int(np.argmin(ties)))]
 
-    for idx, row in enumerate(df[df["cid"].isin(df_out["cid"])].itertuples()):
-        if row.cid not in seen_cids:
-            seen_cids[row.cid] = (row, new_idx_ctr)
-            new_idx_ctr += 1
+    # Sorting the candidates in the order of the df keeps the sort stable with regard to all filtered clusters.
+    return _sort(all_df.iloc[np.sort(sorted_cids)], sort_cols, sort_orders)["cid"].to_numpy()
 
-            for col_name in _PER_INST_COL_NAMES:
-                new_cols[col_name].append(str(getattr(row, col_name)))
+
+def _page_occupancy(state: State, form, cids: np.ndarray):
+    # Returns the rows of the occupancy table of the given clusters that match the search, sorted like the whole
+    # table would be sorted. They are taken in their original order, by instance and then by cid, so the stable sort
+    # puts them in the same relative order.
+    cluster_size = form.clustersize.data
+    all_df = state.dfs[cluster_size - 1]
+    sort_cols, sort_orders = _sort_keys(cluster_size, form)
+    row_idxs = np.sort((np.arange(len(INSTANCES))[:, None] * len(all_df) + cids).ravel())
+    occ = _filter_instances(state.occupancy[cluster_size - 1].iloc[row_idxs], form)
+    return _sort(_with_sort_cols(occ, all_df, sort_cols), sort_cols, sort_orders)
+
+
+def _merge_instances(occ, page_cids: np.ndarray, sort_cols: List[str]) -> Dict[str, List[str]]:
+    # The cluster's values are the same for all its rows, so only the per-instance sort cols can differ.
+    inst_sort_cols = [col_name for col_name in sort_cols if col_name in PLAYER_COL_NAMES]
+    col_names = list(dict.fromkeys(["cid", *_PER_INST_COL_NAMES, *inst_sort_cols]))
+
+    # The first row of each cluster is the winner of the sorting.
+    seen_cids: Dict[int, Tuple[tuple, Dict[str, str]]] = {}
+    for row in occ[col_names].itertuples(index=False):
+        if row.cid not in seen_cids:
+            seen_cids[row.cid] = (row, {col_name: str(getattr(row, col_name)) for col_name in _PER_INST_COL_NAMES})
         else:
-            seen_row, seen_new_idx = seen_cids[row.cid]
-            if all(getattr(row, sc) == getattr(seen_row, sc) for sc in sort_cols):
+            seen_row, merged = seen_cids[row.cid]
+            if all(getattr(row, sc) == getattr(seen_row, sc) for sc in inst_sort_cols):
                 for col_name in _PER_INST_COL_NAMES:
-                    new_cols[col_name][seen_new_idx] += "|" + str(getattr(row, col_name))
+                    merged[col_name] += "|" + str(getattr(row, col_name))
 
-    return df_out.assign(**new_cols)
+    return {col_name: [seen_cids[cid][1][col_name] for cid in page_cids.tolist()] for col_name in _PER_INST_COL_NAMES}
@@ -0,0 +1,363 @@
+# Versioned landscape snapshots in a directory that is shared by all processes serving the app.
+#
+# Exactly one process, the updater, holds the updater lock. It fetches the landscape and the players and publishes them
+# here, while all other processes merely follow the published versions. Each landscape version lives in its own
+# subdirectory. Files are never changed once they are visible; only cluster sizes that the updater materializes after
+# publishing the version (see lazy_sizes) are added later. The occupancy tables of each published player list live in
+# a subdirectory of the landscape version they belong to. All per-cluster data (the cluster dfs, their indexes, and the
+# occupancy tables) is numeric and stored as NumPy arrays that every process maps into memory, so the operating system
+# keeps only one copy of it no matter how many processes serve the app. Only the world itself, whose size is linear in
+# the number of stws, is rebuilt by each process.
+#
+# A process that loads a version pins it with a shared lock on its landscape.pickle, and the updater only prunes
+# versions that are not pinned. Versions that have vanished nevertheless are reported as missing, so the caller can try
+# again with the then current version.
+
+import fcntl
+import logging
+import os
+import pickle
+import shutil
+from datetime import datetime
+from typing import Optional, Tuple, List, Dict, Any, Sequence, Union
+
+import numpy as np
+import pandas as pd
+
+from sts_inquiry import app
+from sts_inquiry.consts import INSTANCES
+from sts_inquiry.pipeline.a_fetch.landscape_fetcher import SuperRegionPrototype, RegionPrototype, EdgePrototype, \
+    StwPrototype
+from sts_inquiry.pipeline.a_fetch.player_fetcher import PlayerPrototype
+from sts_inquiry.pipeline.b_link import link_landscape
+from sts_inquiry.structs import World, ClusterIndex
+
+_SNAPSHOT_DIR = app.config["SNAPSHOT_DIR"]
+_MAX_CLUSTER_SIZE = app.config["MAX_CLUSTER_SIZE"]
+
+# Increment this whenever the layout of the persisted objects or the computation of the metrics changes so that old
+# snapshots are ignored.
+_FORMAT_VERSION = 10
+# Older versions are kept for a while because followers might not have switched to the newest version yet.
+_KEPT_VERSIONS = 2
+
+_OCCUPANCY_INT_COLS = ["cid", "instance", "nghbr_occupants", "region_occupants"]
+
+log = logging.getLogger("sts-inquiry")
+
+_updater_lock_file = None
+
+
+def enabled() -> bool:
+    return bool(_SNAPSHOT_DIR)
+
+
+def acquire_updater_lock() -> bool:
+    # Tries to make this process the updater and returns whether it is the updater now.
+    # The lock is released by the operating system when the process dies, so another process can then take over.
+    global _updater_lock_file
+
+    if not enabled() or _updater_lock_file is not None:
+        return True
+
+    os.makedirs(_SNAPSHOT_DIR, exist_ok=True)
+    lock_file = open(os.path.join(_SNAPSHOT_DIR, "updater.lock"), "w")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        return False
+
+    _updater_lock_file = lock_file
+    return True
+
+
+def is_updater() -> bool:
+    return not enabled() or _updater_lock_file is not None
+
+
+def current_version() -> Optional[str]:
+    try:
+        with open(os.path.join(_SNAPSHOT_DIR, "CURRENT")) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def publish(world: World, dfs: List[Optional[pd.DataFrame]], indexes: List[Optional[ClusterIndex]]) -> str:
+    # Persists the world, the cluster dfs, and their indexes as a new version and makes it the current one.
+    # The world is flattened back into its prototypes, while all columns of the dfs are numeric and stored as matrices.
+    # Cluster sizes that have not been materialized are stored as such and can be added later via
+    # publish_cluster_size().
+    version = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+    log.info(" * Publishing landscape snapshot version %s...", version)
+
+    tmp_dir = os.path.join(_SNAPSHOT_DIR, f"{version}.tmp")
+    os.makedirs(tmp_dir)
+
+    columns, sort_keys = [], []
+    for cluster_size, (df, index) in enumerate(zip(dfs, indexes), start=1):
+        if df is None:
+            columns.append(None)
+            sort_keys.append(None)
+            continue
+        size_columns, size_sort_keys = _save_cluster_size(tmp_dir, cluster_size, df, index)
+        columns.append(size_columns)
+        sort_keys.append(size_sort_keys)
+
+    _dump(os.path.join(tmp_dir, "landscape.pickle"), {
+        "format_version": _FORMAT_VERSION,
+        "created": datetime.now(),
+        "landscape": _unlink_landscape(world),
+        "columns": columns,
+        "sort_keys": sort_keys
+    })
+
+    # Only make the new version visible once it is complete.
+    os.rename(tmp_dir, os.path.join(_SNAPSHOT_DIR, version))
+    _write_atomically(os.path.join(_SNAPSHOT_DIR, "CURRENT"), version.encode())
+    _prune_versions()
+
+    log.info(" * Finished publishing landscape snapshot.")
+    return version
+
+
+def publish_cluster_size(version: str, cluster_size: int, df: pd.DataFrame, index: ClusterIndex):
+    # Adds a cluster size that has been materialized after the given version has been published (see lazy_sizes).
+    # Its metadata is written last, so that followers only see the size once all of its files are complete.
+    version_dir = os.path.join(_SNAPSHOT_DIR, version)
+    columns, sort_keys = _save_cluster_size(version_dir, cluster_size, df, index)
+    _write_atomically(os.path.join(version_dir, f"size-{cluster_size}.pickle"), pickle.dumps({
+        "columns": columns,
+        "sort_keys": sort_keys
+    }, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def load(version: str) -> Optional[Tuple[World, List[Optional[pd.DataFrame]], List[Optional[ClusterIndex]], datetime]]:
+    # Returns the world, cluster dfs, and their indexes of the given version as well as its creation time,
+    # or None if the version does not exist (anymore), in which case the caller should try again later.
+    # Raises an exception if the version is unusable, e.g., because it was created with a different format or config.
+    # The numeric columns of the returned dfs and the indexes are read-only and memory-mapped.
+    version_dir = os.path.join(_SNAPSHOT_DIR, version)
+    try:
+        with open(os.path.join(version_dir, "landscape.pickle"), "rb") as f:
+            # Pin the version until all of its files have been mapped into memory.
+            fcntl.flock(f, fcntl.LOCK_SH)
+            return _load_pinned(version_dir, pickle.load(f))
+    except FileNotFoundError:
+        # The version has been pruned in the meantime.
+        return None
+
+
+def load_cluster_size(version: str, cluster_size: int) -> Optional[Tuple[pd.DataFrame, ClusterIndex]]:
+    # Returns the memory-mapped df and index of a cluster size that has been added to the given version via
+    # publish_cluster_size(), or None if it has not been added (yet) or the version does not exist (anymore).
+    version_dir = os.path.join(_SNAPSHOT_DIR, version)
+    try:
+        with open(os.path.join(version_dir, "landscape.pickle"), "rb") as f:
+            fcntl.flock(f, fcntl.LOCK_SH)
+            with open(os.path.join(version_dir, f"size-{cluster_size}.pickle"), "rb") as size_f:
+                meta = pickle.load(size_f)
+            return _load_cluster_size(version_dir, cluster_size, meta["columns"], meta["sort_keys"])
+    except FileNotFoundError:
+        return None
+
+
+def _load_pinned(version_dir: str, snapshot: Dict[str, Any]) \
+        -> Tuple[World, List[Optional[pd.DataFrame]], List[Optional[ClusterIndex]], datetime]:
+    if snapshot["format_version"] != _FORMAT_VERSION or len(snapshot["columns"]) != _MAX_CLUSTER_SIZE:
+        raise ValueError(f"The landscape snapshot in {version_dir} was created with a different format or config.")
+
+    world = link_landscape(*snapshot["landscape"])
+
+    dfs, indexes = [], []
+    for cluster_size, (columns, sort_keys) in enumerate(zip(snapshot["columns"], snapshot["sort_keys"]), start=1):
+        if columns is None:
+            # The size might have been added since the version has been published.
+            try:
+                with open(os.path.join(version_dir, f"size-{cluster_size}.pickle"), "rb") as f:
+                    meta = pickle.load(f)
+                columns, sort_keys = meta["columns"], meta["sort_keys"]
+            except FileNotFoundError:
+                dfs.append(None)
+                indexes.append(None)
+                continue
+        df, index = _load_cluster_size(version_dir, cluster_size, columns, sort_keys)
+        dfs.append(df)
+        indexes.append(index)
+
+    return world, dfs, indexes, snapshot["created"]
+
+
+def _save_cluster_size(version_dir: str, cluster_size: int, df: pd.DataFrame, index: ClusterIndex) \
+        -> Tuple[Dict[str, List[str]], List[Tuple[str, bool]]]:
+    # Returns the metadata that is needed to load the size again.
+    int_cols = [col_name for col_name in df.columns if df[col_name].dtype.kind in "iub"]
+    float_cols = [col_name for col_name in df.columns if col_name not in int_cols]
+    np.save(os.path.join(version_dir, f"{cluster_size}-int.npy"), df[int_cols].to_numpy(dtype=np.int64))
+    np.save(os.path.join(version_dir, f"{cluster_size}-float.npy"), df[float_cols].to_numpy(dtype=np.float64))
+
+    np.save(os.path.join(version_dir, f"{cluster_size}-index-indptr.npy"), index.indptr)
+    np.save(os.path.join(version_dir, f"{cluster_size}-index-cids.npy"), index.cids)
+    np.save(os.path.join(version_dir, f"{cluster_size}-index-sorted.npy"), np.stack(list(index.sorted_cids.values())))
+    np.save(os.path.join(version_dir, f"{cluster_size}-index-region-indptr.npy"), index.region_indptr)
+    np.save(os.path.join(version_dir, f"{cluster_size}-index-region-cids.npy"), index.region_cids)
+
+    return {"int": int_cols, "float": float_cols}, list(index.sorted_cids)
+
+
+def _load_cluster_size(version_dir: str, cluster_size: int, columns: Dict[str, List[str]],
+                       sort_keys: List[Tuple[str, bool]]) -> Tuple[pd.DataFrame, ClusterIndex]:
+    int_mat = np.load(os.path.join(version_dir, f"{cluster_size}-int.npy"), mmap_mode="r")
+    float_mat = np.load(os.path.join(version_dir, f"{cluster_size}-float.npy"), mmap_mode="r")
+
+    # Building each dtype's df from a single matrix without copying yields one consolidated block per dtype,
+    # which Pandas then has no reason to ever copy out of the memory map.
+    int_df = pd.DataFrame(int_mat, columns=columns["int"], copy=False)
+    float_df = pd.DataFrame(float_mat, columns=columns["float"], copy=False)
+    df = pd.concat((int_df, float_df), axis=1, copy=False)
+
+    sorted_mat = np.load(os.path.join(version_dir, f"{cluster_size}-index-sorted.npy"), mmap_mode="r")
+    index = ClusterIndex(
+        indptr=np.load(os.path.join(version_dir, f"{cluster_size}-index-indptr.npy"), mmap_mode="r"),
+        cids=np.load(os.path.join(version_dir, f"{cluster_size}-index-cids.npy"), mmap_mode="r"),
+        n_clusters=len(df),
+        sorted_cids=dict(zip(sort_keys, sorted_mat)),
+        region_indptr=np.load(os.path.join(version_dir, f"{cluster_size}-index-region-indptr.npy"), mmap_mode="r"),
+        region_cids=np.load(os.path.join(version_dir, f"{cluster_size}-index-region-cids.npy"), mmap_mode="r")
+    )
+    return df, index
+
+
+def publish_occupancy(landscape_version: str, players_version: Union[int, str],
+                      occupancy: Sequence[Optional[pd.DataFrame]]):
+    # Persists the occupancy tables of the given player list next to the given landscape version. Tables that are None
+    # are skipped, so this can be called again once more cluster sizes have been materialized. Publish the player list
+    # itself afterwards so that followers find the tables as soon as they see the player list.
+    players_dir = os.path.join(_SNAPSHOT_DIR, landscape_version, f"players-{players_version}")
+    os.makedirs(players_dir, exist_ok=True)
+    for cluster_size, occ in enumerate(occupancy, start=1):
+        if occ is None:
+            continue
+        # The int matrix is written last, so that its presence implies that the whole table is complete.
+        _save_atomically(os.path.join(players_dir, f"{cluster_size}-occupancy-free.npy"), occ["free"].to_numpy())
+        _save_atomically(os.path.join(players_dir, f"{cluster_size}-occupancy-int.npy"),
+                         occ[_OCCUPANCY_INT_COLS].to_numpy(dtype=np.int64))
+
+
+def load_occupancy(landscape_version: str, players_version: Union[int, str],
+                   dfs: Sequence[Optional[pd.DataFrame]]) -> List[Optional[pd.DataFrame]]:
+    # Returns the published occupancy table of each of the given dfs for the given player list. Tables that have not
+    # been published (yet) are None and need to be computed by the caller. The others are read-only and memory-mapped.
+    players_dir = os.path.join(_SNAPSHOT_DIR, landscape_version, f"players-{players_version}")
+    occupancy = []
+    for cluster_size, df in enumerate(dfs, start=1):
+        try:
+            if df is None:
+                raise FileNotFoundError
+            int_mat = np.load(os.path.join(players_dir, f"{cluster_size}-occupancy-int.npy"), mmap_mode="r")
+            free = np.load(os.path.join(players_dir, f"{cluster_size}-occupancy-free.npy"), mmap_mode="r")
+        except FileNotFoundError:
+            occupancy.append(None)
+            continue
+        if len(int_mat) != len(INSTANCES) * len(df):
+            occupancy.append(None)
+            continue
+        occupancy.append(pd.concat((pd.DataFrame(int_mat, columns=_OCCUPANCY_INT_COLS, copy=False),
+                                    pd.DataFrame({"free": np.asarray(free)}, copy=False)), axis=1, copy=False))
+    return occupancy
+
+
+def publish_players(landscape_version: str, players: List[PlayerPrototype], version: int):
+    _write_atomically(os.path.join(_SNAPSHOT_DIR, "players.pickle"), pickle.dumps({
+        "landscape_version": landscape_version,
+        "version": version,
+        "players": players
+    }, protocol=pickle.HIGHEST_PROTOCOL))
+    _prune_players(landscape_version)
+
+
+def load_players() -> Optional[Dict[str, Any]]:
+    # Returns the last published player list as a dict with the keys landscape_version, version, and players,
+    # or None if none has been published yet.
+    try:
+        with open(os.path.join(_SNAPSHOT_DIR, "players.pickle"), "rb") as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def publish_metrics(text: str):
+    # The updater metrics in the Prometheus text format, so that every process can serve them.
+    _write_atomically(os.path.join(_SNAPSHOT_DIR, "metrics.prom"), text.encode())
+
+
+def load_metrics() -> str:
+    try:
+        with open(os.path.join(_SNAPSHOT_DIR, "metrics.prom")) as f:
+            return f.read()
+    except FileNotFoundError:
+        return ""
+
+
+def _unlink_landscape(world: World) -> Tuple[List[SuperRegionPrototype], List[RegionPrototype],
+                                             List[EdgePrototype], List[StwPrototype]]:
+    superregion_protos = [SuperRegionPrototype(urid=superregion.urid, name=superregion.name)
+                          for superregion in world.superregions]
+    region_protos = [RegionPrototype(rid=region.rid, urid=region.superregion.urid, name=region.name)
+                     for region in world.regions]
+    edge_protos = [EdgePrototype(aid_1=edge.fst().aid, aid_2=edge.snd().aid, handover=edge.handover)
+                   for edge in world.edges]
+    stw_protos = [StwPrototype(aid=stw.aid, rid=stw.region.rid,
+                               name=stw.name, description=stw.description,
+                               latitude=stw.latitude, longitude=stw.longitude,
+                               difficulty=stw.difficulty, entertainment=stw.entertainment,
+                               forum_id=None, comments=stw.comments)
+                  for stw in world.stws]
+    return superregion_protos, region_protos, edge_protos, stw_protos
+
+
+def _prune_versions():
+    versions = sorted(entry.name for entry in os.scandir(_SNAPSHOT_DIR)
+                      if entry.is_dir() and not entry.name.endswith(".tmp"))
+    # Processes that still have old files mapped into memory can keep using them even after they are deleted.
+    # Versions that are still being loaded are pinned and left to a later prune.
+    for version in versions[:-_KEPT_VERSIONS]:
+        version_dir = os.path.join(_SNAPSHOT_DIR, version)
+        try:
+            with open(os.path.join(version_dir, "landscape.pickle"), "rb") as f:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                shutil.rmtree(version_dir, ignore_errors=True)
+        except BlockingIOError:
+            log.info(" * Not pruning landscape snapshot version %s yet because it is still being loaded.", version)
+        except FileNotFoundError:
+            shutil.rmtree(version_dir, ignore_errors=True)
+
+
+def _prune_players(landscape_version: str):
+    # Followers that miss an occupancy table because it has just been pruned simply compute it themselves.
+    landscape_dir = os.path.join(_SNAPSHOT_DIR, landscape_version)
+    players_dirs = sorted((entry.name for entry in os.scandir(landscape_dir)
+                           if entry.is_dir() and entry.name.startswith("players-")),
+                          key=lambda name: int(name[len("players-"):]))
+    for players_dir in players_dirs[:-_KEPT_VERSIONS]:
+        shutil.rmtree(os.path.join(landscape_dir, players_dir), ignore_errors=True)
+
+
+def _dump(path: str, obj):
+    with open(path, "wb") as f:
+        pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _save_atomically(path: str, arr: np.ndarray):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, arr)
+    os.replace(tmp_path, path)
+
+
+def _write_atomically(path: str, content: bytes):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
@@ -1,43 +1,19 @@
 "use strict";
 
 window.addEventListener("load", function () {
-    // Add listeners that load stw image and map as soon as the user activates a tooltip.
+    // Add listeners that load the stw tooltip, and then its image and map, as soon as the user hovers over a stw.
     const stws = document.querySelectorAll("td:nth-child(2) .stw");
     for (let i = 0; i < stws.length; i++) {
         const stw = stws[i];
 
-        const noscript = stw.getElementsByTagName("noscript")[0];
-        const mapPlaceholder = stw.getElementsByClassName("stw-tooltip-map-placeholder")[0];
-
-        if (noscript || mapPlaceholder) {
+        const tooltipPlaceholder = stw.getElementsByClassName("stw-tooltip-placeholder")[0];
+        if (tooltipPlaceholder) {
             stw.addEventListener("mouseenter", function listener() {
                 stw.removeEventListener("mouseenter", listener);
-
-                if (noscript) {
-                    const content = noscript.textContent.trim();
-                    const tmp = document.createElement("div");
-                    tmp.innerHTML = content;
-                    const img = tmp.getElementsByTagName("img")[0];
-                    noscript.parentNode.replaceChild(img, noscript);
-                }
-
-                if (mapPlaceholder) {
-                    const url = mapPlaceholder.textContent.trim();
-                    const iframe = document.createElement("iframe");
-                    iframe.setAttribute("src", url);
-                    iframe.setAttribute("class", "stw-tooltip-map");
-                    mapPlaceholder.parentNode.replaceChild(iframe, mapPlaceholder);
-
-                    // IE 11 fix: Hovering over an iframe should not lose the hover on the parent container.
-                    if (window.navigator.userAgent.indexOf("Trident") > 0) {
-                        iframe.addEventListener("mouseenter", function () {
-                            stw.classList.add("ie-hover");
-                        });
-                        iframe.addEventListener("mouseleave", function () {
-                            stw.classList.remove("ie-hover");
-                        });
-                    }
-                }
+                loadTooltip(stw, tooltipPlaceholder, function () {
+                    // Try again the next time the user hovers over the stw.
+                    stw.addEventListener("mouseenter", listener);
+                });
             });
         }
     }
@@ -69,3 +45,52 @@ window.addEventListener("load", function () {
         window.scrollTo(0, scroll);
     }
 });
+
+function loadTooltip(stw, tooltipPlaceholder, onError) {
+    const request = new XMLHttpRequest();
+    request.addEventListener("load", function () {
+        if (request.status !== 200) {
+            onError();
+            return;
+        }
+        const tmp = document.createElement("div");
+        tmp.innerHTML = JSON.parse(request.responseText).html;
+        const tooltip = tmp.getElementsByClassName("stw-tooltip")[0];
+        tooltipPlaceholder.parentNode.replaceChild(tooltip, tooltipPlaceholder);
+        loadTooltipMedia(stw, tooltip);
+    });
+    request.addEventListener("error", onError);
+    request.open("GET", tooltipPlaceholder.getAttribute("data-src"));
+    request.send();
+}
+
+function loadTooltipMedia(stw, tooltip) {
+    const noscript = tooltip.getElementsByTagName("noscript")[0];
+    const mapPlaceholder = tooltip.getElementsByClassName("stw-tooltip-map-placeholder")[0];
+
+    if (noscript) {
+        const content = noscript.textContent.trim();
+        const tmp = document.createElement("div");
+        tmp.innerHTML = content;
+        const img = tmp.getElementsByTagName("img")[0];
+        noscript.parentNode.replaceChild(img, noscript);
+    }
+
+    if (mapPlaceholder) {
+        const url = mapPlaceholder.textContent.trim();
+        const iframe = document.createElement("iframe");
+        iframe.setAttribute("src", url);
+        iframe.setAttribute("class", "stw-tooltip-map");
+        mapPlaceholder.parentNode.replaceChild(iframe, mapPlaceholder);
+
+        // IE 11 fix: Hovering over an iframe should not lose the hover on the parent container.
+        if (window.navigator.userAgent.indexOf("Trident") > 0) {
+            iframe.addEventListener("mouseenter", function () {
+                stw.classList.add("ie-hover");
+            });
+            iframe.addEventListener("mouseleave", function () {
+                stw.classList.remove("ie-hover");
+            });
+        }
+    }
+}
@@ -2,8 +2,9 @@ from __future__ import annotations
 
 from dataclasses import dataclass
 from datetime import datetime
-from typing import Optional, List, FrozenSet
+from typing import Optional, List, FrozenSet, Dict, Tuple
 
+import numpy as np
 from markupsafe import Markup
 
 
@@ -13,6 +14,75 @@ class World:
     regions: List[Region]
     stws: List[Stw]
     edges: List[Edge]
+    graph: Graph
+
+
+@dataclass(frozen=True)
+class Graph:
+    # A compact representation of the world that is used for all number crunching.
+    # Stws are identified by their index in World.stws, and all per-stw arrays are indexed that way.
+    # The neighbors of stw i are indices[indptr[i]:indptr[i + 1]]; the same slice of handover tells
+    # whether there is a handover to each of them. Duplicate edges are collapsed into one.
+    indptr: np.ndarray
+    indices: np.ndarray
+    handover: np.ndarray
+
+    aids: np.ndarray
+    rids: np.ndarray
+    urids: np.ndarray
+    difficulty: np.ndarray  # NaN if unknown
+    entertainment: np.ndarray  # NaN if unknown
+
+    def neighbors(self, idx: int) -> np.ndarray:
+        return self.indices[self.indptr[idx]:self.indptr[idx + 1]]
+
+    def neighbor_handovers(self, idx: int) -> np.ndarray:
+        return self.handover[self.indptr[idx]:self.indptr[idx + 1]]
+
+
+@dataclass(frozen=True)
+class ClusterIndex:
+    # Indexes over the clusters of one size.
+    # First, an inverted index from the stws to the clusters that contain them:
+    # The cids of the clusters that contain stw i are cids[indptr[i]:indptr[i + 1]], in ascending order.
+    indptr: np.ndarray
+    cids: np.ndarray
+    n_clusters: int
+    # Second, all cids in the order of a stable sort by a single column, by (column name, ascending).
+    sorted_cids: Dict[Tuple[str, bool], np.ndarray]
+    # Third, the clusters sharded by region: the cids of the clusters with at least one stw in World.regions[j] are
+    # region_cids[region_indptr[j]:region_indptr[j + 1]], in ascending order. A cluster that spans several regions
+    # is in the shard of each of them.
+    region_indptr: np.ndarray
+    region_cids: np.ndarray
+
+    def clusters_of(self, idx: int) -> np.ndarray:
+        return self.cids[self.indptr[idx]:self.indptr[idx + 1]]
+
+    def clusters_with_any(self, stw_mask: np.ndarray) -> np.ndarray:
+        # Returns a mask over all cids that tells which clusters contain at least one of the stws in the mask.
+        idxs = np.flatnonzero(stw_mask)
+        starts, lengths = self.indptr[idxs], self.indptr[idxs + 1] - self.indptr[idxs]
+        # Concatenate the posting lists of all selected stws without a Python loop.
+        offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        mask = np.zeros(self.n_clusters, dtype=bool)
+        mask[self.cids[offsets + np.arange(len(offsets))]] = True
+        return mask
+
+    def clusters_in_regions(self, region_mask: np.ndarray) -> np.ndarray:
+        # Returns the cids of the clusters with at least one stw in the regions in the mask, in ascending order.
+        # Only the shards of these regions are touched, and clusters that are in several of them are deduplicated.
+        shards = [self.region_cids[self.region_indptr[pos]:self.region_indptr[pos + 1]]
+                  for pos in np.flatnonzero(region_mask).tolist()]
+        if len(shards) == 1:
+            return shards[0]
+        cids = np.concatenate(shards) if shards else np.zeros(0, dtype=self.region_cids.dtype)
+        # Sorting is only faster than going through a mask over all clusters while there are few cids.
+        if len(cids) * 8 < self.n_clusters:
+            return np.unique(cids)
+        mask = np.zeros(self.n_clusters, dtype=bool)
+        mask[cids] = True
+        return np.flatnonzero(mask)
 
 
 @dataclass(frozen=True)
@@ -67,7 +137,6 @@ class Region:
 class Stw:
     aid: int
     region: Region
-    occupants: List[Player]
 
     neighbors: List[Neighbor]
 
@@ -80,9 +149,6 @@ class Stw:
     entertainment: Optional[float]  # 1 through 4
     comments: List[Comment]
 
-    def occupant_at(self, instance: int):
-        return self.occupants[instance - 1]
-
     def __eq__(self, other):
         return isinstance(other, Stw) and self.aid == other.aid
 
@@ -1,12 +1,22 @@
+import base64
+import binascii
+import hashlib
+import json
 import math
+import time
+from typing import List, Tuple, Optional, Iterator
 from urllib.parse import urlencode
 
 import numpy as np
-from flask import request, url_for, abort, redirect, render_template
+from flask import request, url_for, abort, redirect, render_template, stream_template, jsonify, make_response, \
+    Response, g
 
-from sts_inquiry import app, cache
+from sts_inquiry import app, cache, instrumentation, snapshot
+from sts_inquiry.compression import etag_variants
 from sts_inquiry.forms import create_search_form
-from sts_inquiry.search import search
+from sts_inquiry.instrumentation import SEARCH_SECONDS, REQUEST_SECONDS, SEARCH_CACHE
+from sts_inquiry.lazy_sizes import available
+from sts_inquiry.search import search, rank, records, cache_info
 
 METRIC_COL_LABELS = {
     "intra_handovers": "#C\U0001F517",
@@ -23,6 +33,14 @@ METRIC_COL_LABELS = {
 }
 
 _ROWS_PER_PAGE = app.config["ROWS_PER_PAGE"]
+_HTTP_CACHE_MAX_AGE = app.config["HTTP_CACHE_MAX_AGE"]
+_API_MAX_PAGE_SIZE = app.config["API_MAX_PAGE_SIZE"]
+# Number of characters of a streamed page that are sent at once.
+_STREAM_CHUNK_SIZE = 16384
+# Number of clusters whose records are built at once when exporting all results.
+_EXPORT_CHUNK_SIZE = 1000
+# Number of seconds after which clients should retry a search for a cluster size that is still being materialized.
+_RETRY_AFTER = 30
 
 _LEGACY_PARAM_KEYS = {
     "name": "nameincl"
@@ -47,13 +65,29 @@ def error(_):
     return render_template("503.html"), 503
 
 
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def stop_timer(response):
+    # Streamed responses are only closed once the whole body has been sent.
+    if "request_start" in g and request.endpoint is not None:
+        start, endpoint = g.request_start, request.endpoint
+        response.call_on_close(lambda: REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint=endpoint))
+    return response
+
+
 @app.route("/")
 def index():
-    if not cache.ready:
+    # Work on the same state for the whole request, even if the cache is updated in the meantime.
+    state = cache.get()
+    if state is None:
         abort(503)
 
     form = create_search_form(request.args,
-                              max_cluster_size=len(cache.dfs), superregions=cache.world.superregions,
+                              max_cluster_size=len(state.dfs), superregions=state.world.superregions,
                               sortable_cols=list(METRIC_COL_LABELS.items()))
 
     # Add used=True or used=False to each field depending on whether it contains a value that is not the default.
@@ -67,6 +101,13 @@ def index():
     if query_cleansing_necessary:
         return redirect(url_for("index") + "?" + urlencode(search_params + other_params), 302)
 
+    # The page only changes with the landscape and the players, so clients and proxies that have already seen it
+    # need not wait for the search again.
+    etag = _page_etag(state, search_params + other_params)
+    known_etag = _known_etag(etag)
+    if known_etag is not None:
+        return _cacheable(Response(status=304), known_etag)
+
     try:
         page = int(request.args["page"])
     except (KeyError, TypeError, ValueError):
@@ -77,7 +118,12 @@ def index():
     except (KeyError, TypeError, ValueError):
         highlight_cluster_aids = None
 
-    cluster_size, page, highlight_row_idx, n_total_rows, rows = search(form, page, highlight_cluster_aids)
+    # Large cluster sizes are only available once they have been materialized in the background.
+    if not available(state, form.clustersize.data):
+        return _retry_later(make_response(render_template("503.html", materializing=True), 503))
+
+    cluster_size, page, highlight_row_idx, n_total_rows, rows = search(state, form, page, highlight_cluster_aids,
+                                                                        _canonical(search_params))
 
     # Detect too high page numbers or highlight clusters that cannot be found; then, redirect.
     if (not rows and page != 1) or (highlight_cluster_aids and highlight_row_idx is None):
@@ -93,13 +139,180 @@ def index():
         stw_coords = [(_coordfun(v + 0.5), _coordfun(v + 0.25))
                       for v in np.linspace(0, 1, cluster_size, endpoint=False)]
 
-    return render_template("index.html",
-                           form=form,
-                           metric_col_labels=METRIC_COL_LABELS, cluster_size=cluster_size, stw_coords=stw_coords,
-                           instance=form.instance.data if form.instance.used else None,
-                           rows=rows, n_total_rows=n_total_rows,
-                           highlight_row_idx=highlight_row_idx,
-                           search_params=search_params, cur_page=page, prev_pages=prev_pages, next_pages=next_pages)
+    template_context = dict(form=form,
+                            metric_col_labels=METRIC_COL_LABELS, cluster_size=cluster_size, stw_coords=stw_coords,
+                            instance=form.instance.data if form.instance.used else None,
+                            rows=rows, n_total_rows=n_total_rows,
+                            occupant_at=state.occupant_at, stw_fragments=state.stw_fragments,
+                            landscape_version=state.landscape_version,
+                            highlight_row_idx=highlight_row_idx,
+                            search_params=search_params, cur_page=page, prev_pages=prev_pages, next_pages=next_pages)
+    if app.config["STREAM_PAGES"]:
+        # Send the beginning of the page while the rows are still being rendered. The state is only referenced by the
+        # template context, so updates of the cache are not held up by slow clients.
+        pieces = SEARCH_SECONDS.time_iter(stream_template("index.html", **template_context), phase="render")
+        response = Response(_chunked(pieces), mimetype="text/html")
+    else:
+        with SEARCH_SECONDS.time(phase="render"):
+            response = make_response(render_template("index.html", **template_context))
+    return _cacheable(response, etag)
+
+
+@app.route("/stw/<int:aid>/tooltip")
+def stw_tooltip(aid: int):
+    # Serves the tooltip of a stw, which the result pages only load once the user hovers over the stw.
+    state = cache.get()
+    if state is None:
+        abort(503)
+    tooltip = state.stw_fragments.tooltips.get(aid)
+    if tooltip is None:
+        abort(404)
+
+    etag = f"{state.landscape_version}-{aid}"
+    known_etag = _known_etag(etag)
+    if known_etag is not None:
+        response = Response(status=304)
+        response.set_etag(known_etag)
+    else:
+        response = jsonify(aid=aid, html=tooltip)
+        response.set_etag(etag)
+    if request.args.get("v") == state.landscape_version:
+        # The result pages put the landscape version into the URL, so the content behind the URL never changes.
+        response.cache_control.public = True
+        response.cache_control.max_age = 365 * 86400
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+
+@app.route("/api/search")
+def api_search():
+    # Answers the same searches as the result pages with plain data. Pages are requested via the opaque cursor that
+    # the previous page returns, and with format=ndjson, all results are streamed as one JSON object per line.
+    state = cache.get()
+    if state is None:
+        return jsonify(error="The data is not available yet."), 503
+
+    form = create_search_form(request.args,
+                              max_cluster_size=len(state.dfs), superregions=state.world.superregions,
+                              sortable_cols=list(METRIC_COL_LABELS.items()))
+    invalid_fields = [field.name for field in form if field.name in request.args and not field.validate(form)]
+    if invalid_fields:
+        return jsonify(error=f"Invalid search params: {', '.join(invalid_fields)}"), 400
+    form.mark_used_fields()
+    _, search_params, _ = _process_params(form)
+
+    export = request.args.get("format") == "ndjson"
+    try:
+        limit = int(request.args.get("limit", _ROWS_PER_PAGE))
+    except ValueError:
+        limit = 0
+    if not export and not 1 <= limit <= _API_MAX_PAGE_SIZE:
+        return jsonify(error=f"The limit must be between 1 and {_API_MAX_PAGE_SIZE}."), 400
+
+    # A cursor is only valid for the search and the state it was created for, as the ranking changes otherwise.
+    results_etag = _page_etag(state, search_params)
+    offset = 0
+    if not export and "cursor" in request.args:
+        try:
+            cursor = json.loads(base64.urlsafe_b64decode(request.args["cursor"]))
+            offset = int(cursor["offset"])
+            cursor_etag = cursor["results"]
+            if offset < 0:
+                raise ValueError()
+        except (binascii.Error, ValueError, TypeError, KeyError):
+            return jsonify(error="Invalid cursor."), 400
+        if cursor_etag != results_etag:
+            return jsonify(error="The results have changed since the cursor was created; start over."), 410
+
+    etag = _page_etag(state, search_params + [("format", "ndjson")] if export
+                      else search_params + [("offset", str(offset)), ("limit", str(limit))])
+    known_etag = _known_etag(etag)
+    if known_etag is not None:
+        return _cacheable(Response(status=304), known_etag)
+
+    cluster_size = form.clustersize.data
+    if not available(state, cluster_size):
+        return _retry_later(jsonify(error="The clusters of this size are still being computed; try again later."))
+    ranking = rank(state, form, None if export else offset + limit, _canonical(search_params))
+
+    if export:
+        def export_lines() -> Iterator[str]:
+            for start in range(0, len(ranking.cids), _EXPORT_CHUNK_SIZE):
+                chunk = records(state, form, ranking.cids[start:start + _EXPORT_CHUNK_SIZE])
+                yield "".join(json.dumps({"rank": start + idx, "cluster_size": cluster_size, **record}) + "\n"
+                              for idx, record in enumerate(chunk))
+
+        response = Response(export_lines(), mimetype="application/x-ndjson")
+        response.headers["X-Total-Count"] = str(ranking.n_total_rows)
+        return _cacheable(response, etag)
+
+    page_cids = ranking.cids[offset:offset + limit]
+    rows = [{"rank": offset + idx, **record} for idx, record in enumerate(records(state, form, page_cids))]
+    next_cursor = None
+    if offset + limit < ranking.n_total_rows:
+        next_cursor = base64.urlsafe_b64encode(json.dumps({"offset": offset + limit,
+                                                           "results": results_etag}).encode()).decode()
+    return _cacheable(jsonify(cluster_size=cluster_size, total=ranking.n_total_rows, rows=rows,
+                              next_cursor=next_cursor), etag)
+
+
+@app.route("/metrics")
+def metrics():
+    # Exposes the instrumentation in the Prometheus text format: the request metrics of this process, and the updater
+    # metrics of the updater process, which publishes them next to the snapshots.
+    if not app.config["METRICS_ENABLED"]:
+        abort(404)
+    for stat, value in cache_info().items():
+        SEARCH_CACHE.set(value, stat=stat)
+    if snapshot.is_updater():
+        text = instrumentation.render()
+    else:
+        text = instrumentation.render(updater=False) + snapshot.load_metrics()
+    return Response(text, content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+def _page_etag(state: cache.State, params: List[Tuple[str, str]]) -> str:
+    return hashlib.blake2b(repr((state.landscape_version, state.players_version, _canonical(params))).encode(),
+                           digest_size=16).hexdigest()
+
+
+def _canonical(params: List[Tuple[str, str]]) -> Tuple[Tuple[str, str], ...]:
+    # The same search in any order of the params. Repeated params keep their order, as it might matter.
+    return tuple(sorted(params, key=lambda param: param[0]))
+
+
+def _chunked(pieces: Iterator[str]) -> Iterator[str]:
+    # Jinja emits lots of tiny pieces, so join them into chunks that are worth sending.
+    chunk, chunk_len = [], 0
+    for piece in pieces:
+        chunk.append(piece)
+        chunk_len += len(piece)
+        if chunk_len >= _STREAM_CHUNK_SIZE:
+            yield "".join(chunk)
+            chunk, chunk_len = [], 0
+    if chunk:
+        yield "".join(chunk)
+
+
+def _known_etag(etag: str) -> Optional[str]:
+    # Returns the variant of the ETag that the client already has a response for, if any.
+    return next((variant for variant in etag_variants(etag) if request.if_none_match.contains(variant)), None)
+
+
+def _retry_later(response: Response) -> Response:
+    response.status_code = 503
+    response.headers["Retry-After"] = str(_RETRY_AFTER)
+    return response
+
+
+def _cacheable(response: Response, etag: str) -> Response:
+    response.set_etag(etag)
+    # The player markers show how long each stw has been occupied, so shared caches must not keep pages for too long.
+    response.cache_control.public = True
+    response.cache_control.max_age = _HTTP_CACHE_MAX_AGE
+    return response
 
 
 def _process_params(form):
@@ -0,0 +1,11 @@
+# The tests use the benchmark settings, which never touch the Sts website, and the synthetic landscape of the
+# benchmarks. Both must be set up before sts_inquiry is imported, which reads the settings right away.
+
+import os
+import sys
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+os.environ.setdefault("STS_INQUIRY_SETTINGS", os.path.join(_ROOT, "benchmarks", "settings.cfg"))
+sys.path.insert(0, _ROOT)
+sys.path.insert(0, os.path.join(_ROOT, "benchmarks"))
@@ -0,0 +1,45 @@
+# Patching the cluster dfs after small landscape changes must yield the same dfs as a full rebuild.
+
+import pandas as pd
+import pytest
+
+from bench_delta import mutate
+from synthetic import synthetic_landscape
+from sts_inquiry.pipeline import run_cluster_size_pipeline, patch_cluster_size_pipeline
+from sts_inquiry.pipeline.b_link import link_landscape, diff_landscape
+from sts_inquiry.pipeline.c_cluster import cluster_landscape, cluster_around
+from sts_inquiry.pipeline.d_metrics import landscape_metrics, patch_landscape_metrics
+
+
+@pytest.fixture(scope="module")
+def worlds():
+    old_protos = synthetic_landscape(1)
+    return link_landscape(*old_protos), link_landscape(*mutate(old_protos))
+
+
+def test_patched_landscape_equals_full_rebuild(worlds):
+    old_world, new_world = worlds
+    old_dfs = list(landscape_metrics(old_world, cluster_landscape(old_world)))
+
+    full_dfs = list(landscape_metrics(new_world, cluster_landscape(new_world)))
+    changed_aids = diff_landscape(old_world, new_world)
+    delta_dfs = list(patch_landscape_metrics(new_world, old_world, old_dfs, changed_aids,
+                                             cluster_around(new_world, changed_aids)))
+
+    assert changed_aids
+    assert len(delta_dfs) == len(full_dfs)
+    for full_df, delta_df in zip(full_dfs, delta_dfs):
+        pd.testing.assert_frame_equal(full_df, delta_df)
+
+
+@pytest.mark.parametrize("cluster_size", [1, 3, 5])
+def test_patched_cluster_size_equals_full_rebuild(worlds, cluster_size):
+    old_world, new_world = worlds
+    old_df, _ = run_cluster_size_pipeline(old_world, cluster_size)
+
+    full_df, full_index = run_cluster_size_pipeline(new_world, cluster_size)
+    delta_df, delta_index = patch_cluster_size_pipeline(new_world, old_world, old_df, cluster_size)
+
+    pd.testing.assert_frame_equal(full_df, delta_df)
+    assert (full_index.indptr == delta_index.indptr).all()
+    assert (full_index.cids == delta_index.cids).all()
@@ -0,0 +1,62 @@
+# The fetch engine against the local stand-in for the Sts website.
+
+import threading
+
+import pytest
+import requests
+
+from fixture_server import FixtureServer
+from sts_inquiry.pipeline.a_fetch.fetch_engine import FetchEngine
+from sts_inquiry.pipeline.a_fetch.response_store import ResponseStore
+
+_N_PAGES = 40
+
+
+@pytest.fixture(scope="module")
+def server():
+    server = FixtureServer({f"page-{i}": f"content {i}".encode() for i in range(_N_PAGES)})
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def engine():
+    with FetchEngine("sts-inquiry-tests", timeout=10, max_in_flight=8, rate_limit=0) as engine:
+        yield engine
+
+
+def test_map_returns_results_in_item_order(server, engine):
+    def fetch(i):
+        return engine.get(f"{server.url}page-{i}").content
+
+    assert engine.map(fetch, range(_N_PAGES)) == [f"content {i}".encode() for i in range(_N_PAGES)]
+
+
+def test_map_reraises_exception_of_first_failed_item(server, engine):
+    # The later item fails first, but a sequential loop would have stopped at the earlier one.
+    later_failed = threading.Event()
+
+    def fetch(i):
+        if i == 5:
+            later_failed.wait(10)
+        resp = engine.get(f"{server.url}{'missing' if i in (5, 20) else 'page'}-{i}")
+        if i == 20:
+            later_failed.set()
+        resp.raise_for_status()
+        return resp.content
+
+    with pytest.raises(requests.HTTPError) as exc_info:
+        engine.map(fetch, range(_N_PAGES))
+    assert exc_info.value.response.url.endswith("missing-5")
+
+
+def test_get_content_sends_conditional_requests(server, tmp_path):
+    with FetchEngine("sts-inquiry-tests", timeout=10, max_in_flight=2, rate_limit=0,
+                     store=ResponseStore(str(tmp_path))) as engine:
+        first = engine.get_content(f"{server.url}page-1")
+        n_not_modified = server.n_not_modified
+        second = engine.get_content(f"{server.url}page-1")
+
+    assert first == second
+    assert first[0] == b"content 1" and first[1] is not None
+    assert server.n_not_modified == n_not_modified + 1
@@ -0,0 +1,42 @@
+# Searches over a tiny landscape whose scores are chosen to expose rounding errors.
+
+from markupsafe import Markup
+
+import pytest
+
+from sts_inquiry import app, cache
+from sts_inquiry.pipeline import apply_players
+from sts_inquiry.pipeline.a_fetch.landscape_fetcher import SuperRegionPrototype, RegionPrototype, EdgePrototype, \
+    StwPrototype
+from sts_inquiry.pipeline.b_link import link_landscape
+from sts_inquiry.pipeline.c_cluster import cluster_landscape
+from sts_inquiry.pipeline.d_metrics import landscape_metrics, cluster_index
+
+
+def _stw(aid: int, difficulty: float, entertainment: float) -> StwPrototype:
+    return StwPrototype(aid=aid, rid=1, name=f"Stw {aid}", description=Markup(""), latitude=50, longitude=8,
+                        difficulty=difficulty, entertainment=entertainment, forum_id=None, comments=[])
+
+
+@pytest.fixture(scope="module")
+def client():
+    # Both pairs have a mean difficulty of 1.65, but 1.1 + 2.2 != 1.3 + 2.0 in floating point.
+    protos = ([SuperRegionPrototype(urid=1, name="Superregion")], [RegionPrototype(rid=1, urid=1, name="Region")],
+              [EdgePrototype(aid_1=1, aid_2=2, handover=False), EdgePrototype(aid_1=3, aid_2=4, handover=False)],
+              [_stw(1, 1.1, 1.0), _stw(2, 2.2, 1.0), _stw(3, 1.3, 3.0), _stw(4, 2.0, 3.0)])
+    world = link_landscape(*protos)
+    dfs = list(landscape_metrics(world, cluster_landscape(world)))
+    indexes = [cluster_index(world, df, cluster_size) for cluster_size, df in enumerate(dfs, start=1)]
+    cache.update(world, dfs, indexes, *apply_players(world, dfs, []))
+    return app.test_client()
+
+
+@pytest.mark.parametrize("sortby2, expected", [("mean_entertainment-asc", [[1, 2], [3, 4]]),
+                                               ("mean_entertainment-desc", [[3, 4], [1, 2]])])
+def test_equal_means_are_ordered_by_secondary_sort(client, sortby2, expected):
+    resp = client.get(f"/api/search?clustersize=2&sortby1=mean_difficulty-desc&sortby2={sortby2}&limit=10")
+
+    assert resp.status_code == 200
+    rows = resp.get_json()["rows"]
+    assert [row["mean_difficulty"] for row in rows] == [1.65, 1.65]
+    assert [row["aids"] for row in rows] == expected